@@ -0,0 +1,283 @@
+from clients import load_config
+from collections import deque
+from dataclasses import dataclass
+import contextlib
+import contextvars
+import functools
+import math
+import os
+import streamlit as st
+import threading
+import time
+import tracing
+
+
+# How often waiting requests re-check for a free slot (and refresh their ETA)
+POLL_INTERVAL = 0.25
+
+# Recent call durations kept per backend for the wait estimate
+DURATION_WINDOW = 20
+
+
+@dataclass(frozen=True)
+class Limit:
+    rate: float = 0  # calls per second (0: unlimited)
+    burst: int = 1
+    concurrency: int = 0  # calls in flight (0: unlimited)
+    queue: int = 0  # requests allowed to wait (0: unlimited)
+
+
+# Default Limits per Backend, each overridable as ADMISSION_<BACKEND>_<FIELD>
+# (a replicate slot covers a whole prediction when the session waits for it, as
+# in multi-style mode and the CLI, but only its creation when polled in the
+# background: a slot held across reruns would leak with abandoned sessions)
+LIMITS = {
+    "cloudflare": Limit(rate=10, burst=10, concurrency=8, queue=64),
+    "cloudflare_worker": Limit(rate=5, burst=5, concurrency=4, queue=32),
+    "replicate": Limit(rate=5, burst=5, concurrency=8, queue=32),
+    "openai": Limit(rate=1, burst=3, concurrency=4, queue=32),
+}
+
+
+class Overloaded(Exception):
+    pass
+
+
+# Gates a process sets up itself, ahead of the configured ones (see use_limits)
+_gates = {}
+
+# Where a Session shows its queue position, set once per script run
+_wait_display = contextvars.ContextVar("wait_display", default=None)
+
+
+def use_wait_display(callback):
+    # callback(backend, position, eta_seconds), then position None once admitted
+    _wait_display.set(callback)
+
+
+def show_waits(placeholder=None):
+    placeholder = placeholder or st.empty()
+
+    def display(backend, position, eta):
+        if position is None:
+            placeholder.empty()
+        else:
+            placeholder.info(
+                f"🚦 {backend} is busy: you are #{position} in line "
+                f"(about {eta:.0f}s to go)"
+            )
+
+    use_wait_display(display)
+
+
+# Cross-process Slots and Token Bucket, shared through lock files in a directory
+class FileLocks:
+
+    def __init__(self, directory, backend, limit):
+        import fcntl
+
+        self.fcntl = fcntl
+        self.limit = limit
+        os.makedirs(directory, exist_ok=True)
+        self.slot_paths = [
+            os.path.join(directory, f"{backend}.slot{i}")
+            for i in range(limit.concurrency)
+        ]
+        self.bucket_path = os.path.join(directory, f"{backend}.bucket")
+
+    def take_slot(self):
+        for path in self.slot_paths:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                self.fcntl.flock(fd, self.fcntl.LOCK_EX | self.fcntl.LOCK_NB)
+                return fd
+            except BlockingIOError:
+                os.close(fd)
+        return None
+
+    def release_slot(self, fd):
+        self.fcntl.flock(fd, self.fcntl.LOCK_UN)
+        os.close(fd)
+
+    def take_token(self):
+        with open(self.bucket_path, "a+") as f:
+            self.fcntl.flock(f, self.fcntl.LOCK_EX)
+            f.seek(0)
+            state = f.read().split()
+            now = time.time()
+            tokens, updated = map(float, state) if state else (self.limit.burst, now)
+            wait, tokens = refill_and_take(tokens, updated, now, self.limit)
+            f.seek(0)
+            f.truncate()
+            f.write(f"{tokens} {now}")
+            return wait
+
+
+def refill_and_take(tokens, updated, now, limit):
+    # Token Bucket: returns (seconds until a token is due, tokens left)
+    tokens = min(limit.burst, tokens + (now - updated) * limit.rate)
+    if tokens >= 1:
+        return 0, tokens - 1
+    return (1 - tokens) / limit.rate, tokens
+
+
+# Admission to one Backend: FIFO queue, token bucket rate and concurrency cap
+class Gate:
+
+    def __init__(self, backend, limit, lock_dir=None):
+        self.backend = backend
+        self.limit = limit
+        self.active = 0
+        self._waiting = []
+        self._tokens = limit.burst
+        self._updated = time.monotonic()
+        self._durations = deque(maxlen=DURATION_WINDOW)
+        self._condition = threading.Condition()
+        self._files = (
+            FileLocks(lock_dir, backend, limit)
+            if lock_dir and limit.concurrency
+            else None
+        )
+
+    @property
+    def queue_depth(self):
+        with self._condition:
+            return len(self._waiting)
+
+    def estimate(self, position):
+        # Seconds until the request at this queue position is admitted
+        duration = sum(self._durations) / len(self._durations) if self._durations else 0
+        by_slots = (
+            math.ceil(position / self.limit.concurrency) * duration
+            if self.limit.concurrency
+            else 0
+        )
+        by_rate = position / self.limit.rate if self.limit.rate else 0
+        return max(by_slots, by_rate)
+
+    def _free_capacity(self):
+        # Callers that could be admitted right now, who do not count as queued
+        slots = (
+            self.limit.concurrency - self.active if self.limit.concurrency else math.inf
+        )
+        tokens = math.inf
+        if self.limit.rate and not self._files:
+            elapsed = time.monotonic() - self._updated
+            tokens = math.floor(
+                min(self.limit.burst, self._tokens + elapsed * self.limit.rate)
+            )
+        return max(0, min(slots, tokens))
+
+    def _take_token(self):
+        if not self.limit.rate:
+            return 0
+        if self._files:
+            return self._files.take_token()
+        now = time.monotonic()
+        wait, self._tokens = refill_and_take(
+            self._tokens, self._updated, now, self.limit
+        )
+        self._updated = now
+        return wait
+
+    def _take_slot(self):
+        if self.limit.concurrency and self.active >= self.limit.concurrency:
+            return None
+        if self._files:
+            return self._files.take_slot()
+        return True
+
+    def _release_slot(self, slot):
+        if self._files:
+            self._files.release_slot(slot)
+
+    def _try_admit(self, ticket):
+        # Only the head of the queue may take a slot, then a token
+        if self._waiting[0] is not ticket:
+            return None, POLL_INTERVAL
+        slot = self._take_slot()
+        if slot is None:
+            return None, POLL_INTERVAL
+        wait = self._take_token()
+        if wait:
+            self._release_slot(slot)
+            return None, min(wait, POLL_INTERVAL)
+        self._waiting.remove(ticket)
+        self.active += 1
+        return slot, 0
+
+    @contextlib.contextmanager
+    def admit(self):
+        ticket = object()
+        queued = time.monotonic()
+        display = _wait_display.get()
+        with self._condition:
+            waiting = len(self._waiting) - self._free_capacity()
+            if self.limit.queue and waiting >= self.limit.queue:
+                tracing.record_span("queue", 0, self.backend, outcome="shed")
+                raise Overloaded(
+                    f"{self.backend} is busy ({waiting} requests waiting). "
+                    "Please try again in a moment."
+                )
+            self._waiting.append(ticket)
+
+        waited = False
+        try:
+            while True:
+                with self._condition:
+                    slot, wait = self._try_admit(ticket)
+                    if slot is not None:
+                        break
+                    position = self._waiting.index(ticket) + 1
+                    eta = self.estimate(position)
+                if display:
+                    display(self.backend, position, eta)
+                    waited = True
+                with self._condition:
+                    self._condition.wait(wait)
+        except BaseException:
+            with self._condition:
+                self._waiting.remove(ticket)
+                self._condition.notify_all()
+            raise
+
+        tracing.record_span("queue", time.monotonic() - queued, self.backend)
+        started = time.monotonic()
+        try:
+            if waited:
+                display(self.backend, None, 0)
+            yield
+        finally:
+            with self._condition:
+                self.active -= 1
+                self._release_slot(slot)
+                self._durations.append(time.monotonic() - started)
+                self._condition.notify_all()
+
+
+def get_limit(backend, config):
+    limit = LIMITS.get(backend, Limit())
+    prefix = f"ADMISSION_{backend.upper()}_"
+    return Limit(
+        rate=float(config.get(f"{prefix}RATE", limit.rate)),
+        burst=int(config.get(f"{prefix}BURST", limit.burst)),
+        concurrency=int(config.get(f"{prefix}CONCURRENCY", limit.concurrency)),
+        queue=int(config.get(f"{prefix}QUEUE", limit.queue)),
+    )
+
+
+@functools.cache
+def get_gate(backend):
+    # One Gate per backend and process; ADMISSION_LOCK_DIR shares limits across processes
+    config = load_config()
+    return Gate(backend, get_limit(backend, config), config.get("ADMISSION_LOCK_DIR"))
+
+
+def use_limits(limits):
+    # Replace the configured Limits in this process, e.g. by a batch job's flags
+    for backend, limit in limits.items():
+        _gates[backend] = Gate(backend, limit)
+
+
+def admit(backend):
+    return (_gates.get(backend) or get_gate(backend)).admit()
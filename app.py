@@ -1,12 +1,32 @@
-from dotenv import dotenv_values
-from PIL import Image
-from requests_toolbelt.multipart.encoder import MultipartEncoder
-import base64
-import io
-import openai
+from cache import hash_bytes, make_key, result_cache
+from clients import get_openai_client, get_replicate_client, load_config
+from preprocess import (
+    OUTPUT_FORMAT,
+    OUTPUT_FORMATS,
+    OUTPUT_QUALITY,
+    UPLOAD_QUALITY,
+    VISION_DETAIL,
+    open_image,
+    prepare_output,
+    prepare_preview,
+    prepare_upload,
+)
+from results import (
+    drop_results,
+    load_errors,
+    load_results,
+    save_errors,
+    save_results,
+)
+import admission
+import cartoonize
+import gallery
+import jobs
+import resilience
 import streamlit as st
-import replicate
-import requests
+import time
+import tracing
+import widgets
 
 
 # Streamlit App UI
@@ -17,28 +37,25 @@ st.set_page_config(
 st.title("Cartoonize")
 
 
-# Load Configuration
-if "CUSTOM_LOGIN_ID" in st.secrets:
-    LOGIN_ID = st.secrets["CUSTOM_LOGIN_ID"]
-    LOGIN_PW = st.secrets["CUSTOM_LOGIN_PW"]
-    IMAGE_ACCOUNT_ID = st.secrets["CLOUDFLARE_ACCOUNT_ID"]
-    IMAGE_API_URL = st.secrets["CLOUDFLARE_API_URL"]
-    IMAGE_API_KEY = st.secrets["CLOUDFLARE_API_TOKEN_IMAGES"]
-    GPT_API_KEY1 = st.secrets["OPENAI_API_KEY"]
-    GPT_MODEL1 = st.secrets["OPENAI_MODEL_TTI"]
-    GPT_API_KEY2 = st.secrets["REPLICATE_API_TOKEN"]
-    GPT_MODEL2 = st.secrets["REPLICATE_MODEL_ITI"]
-else:
-    config = dotenv_values(".env")
-    LOGIN_ID = config["CUSTOM_LOGIN_ID"]
-    LOGIN_PW = config["CUSTOM_LOGIN_PW"]
-    IMAGE_ACCOUNT_ID = config["CLOUDFLARE_ACCOUNT_ID"]
-    IMAGE_API_URL = config["CLOUDFLARE_API_URL"]
-    IMAGE_API_KEY = config["CLOUDFLARE_API_TOKEN_IMAGES"]
-    GPT_API_KEY1 = config["OPENAI_API_KEY"]
-    GPT_MODEL1 = config["OPENAI_MODEL_TTI"]
-    GPT_API_KEY2 = config["REPLICATE_API_TOKEN"]
-    GPT_MODEL2 = config["REPLICATE_MODEL_ITI"]
+# Load Configuration (read once per process)
+config = load_config()
+LOGIN_ID = config.get("CUSTOM_LOGIN_ID")
+LOGIN_PW = config.get("CUSTOM_LOGIN_PW")
+IMAGE_API_KEY = config.get("CLOUDFLARE_API_TOKEN_IMAGES")
+IMAGE_INPUT = config.get("REPLICATE_IMAGE_INPUT", cartoonize.REPLICATE_INPUT)
+IMAGE_QUALITY = int(config.get("UPLOAD_IMAGE_QUALITY", UPLOAD_QUALITY))
+GPT_API_KEY1 = config.get("OPENAI_API_KEY")
+GPT_MODEL1 = config.get("OPENAI_MODEL_TTI")
+GPT_VISION_DETAIL = config.get("OPENAI_VISION_DETAIL", VISION_DETAIL)
+GPT_API_KEY2 = config.get("REPLICATE_API_TOKEN")
+GPT_MODEL2 = config.get("REPLICATE_MODEL_ITI")
+OUTPUT_FORMAT = config.get("OUTPUT_IMAGE_FORMAT", OUTPUT_FORMAT)
+OUTPUT_QUALITY = int(config.get("OUTPUT_IMAGE_QUALITY", OUTPUT_QUALITY))
+
+CARTOON_STYLES = cartoonize.CARTOON_STYLES
+
+# Expose Stage Metrics (only when METRICS_PORT is configured)
+tracing.start_metrics_server()
 
 
 def login():
@@ -52,23 +69,40 @@ def login():
         st.warning("Check your Account!")
 
 
-def upload_image_to_storage(image_file):
-    encoder = MultipartEncoder(
-        fields={"file": (image_file.name, image_file, "image/jpeg")}
-    )
-    headers = {
-        "Authorization": f"Bearer {IMAGE_API_KEY}",
-        "Content-Type": encoder.content_type,
-    }
+def keep_results(results, backend, model, params=None, prompt=None, seconds=None):
+    # Persist Results in the Gallery (entries it already holds are skipped)
+    for style, result in results.items():
+        gallery.save(
+            gallery.session_user(),
+            "app.py",
+            result["image"],
+            backend=backend,
+            model=model,
+            style=cartoonize.get_style_name(style),
+            prompt=prompt,
+            caption=result["caption"],
+            params=(params or {}).get(style),
+            seconds=seconds,
+        )
 
-    IMAGE_UPLOAD_URL = f"{IMAGE_API_URL}/{IMAGE_ACCOUNT_ID}/images/v1"
-    response = requests.post(IMAGE_UPLOAD_URL, headers=headers, data=encoder)
 
-    if response.status_code == 200:
-        return response.json()["result"]["variants"][0]
-    else:
-        st.error(f"Failed to upload: {response.text}")
-        return None
+def show_style_results(results, file_name):
+    columns = st.columns(2 if len(results) > 1 else 1)
+    for i, (style, result) in enumerate(results.items()):
+        # Compact Encoding for the browser (encoded once per result)
+        output, output_format = prepare_output(
+            result["image"], OUTPUT_FORMAT, OUTPUT_QUALITY
+        )
+        _, mime, extension = OUTPUT_FORMATS[output_format]
+        with columns[i % 2]:
+            st.image(output, caption=result["caption"], use_container_width=True)
+            st.download_button(
+                "Download",
+                data=output,
+                file_name=f"{file_name}-{cartoonize.get_style_name(style).lower()}.{extension}",
+                mime=mime,
+                key=f"download_{style}",
+            )
 
 
 # Show Login Form
@@ -97,17 +131,16 @@ with st.sidebar:
     )
 
     # Cartoon Style
-    selected_style = st.selectbox(
-        "Choose a Cartoon Style",
-        (
-            "디즈니 | Disney",
-            "픽사 | Pixar",
-            "지브리 | Studio Ghibli",
-            "마블 | Marvel Hero",
-            "아이돌 | K-Pop Star",
-            "미정 | User Prompt",
-        ),
-    )
+    selected_style = st.selectbox("Choose a Cartoon Style", CARTOON_STYLES)
+
+    # Multi-Style Mode (one upload, all styles transformed concurrently)
+    generate_all = False
+    if selected_input.split(" | ")[1] != "prompt":
+        generate_all = st.toggle("Generate all selected styles")
+        if generate_all:
+            selected_styles = st.multiselect(
+                "Choose Cartoon Styles", CARTOON_STYLES, default=CARTOON_STYLES[:5]
+            )
 
     # Aspect Ratio
     selected_ratio = (
@@ -151,6 +184,12 @@ with st.sidebar:
             value=10,  # natural (5~6), strong (9~12)
         )
 
+    # Result Cache (turn off for a fresh variation of the same input)
+    reuse_results = st.checkbox("Reuse previous results", value=True)
+
+    # Stage Timings of the latest Action
+    show_timings = st.checkbox("Show stage timings")
+
     # Link to Github Repo
     st.markdown("---")
     github_link = "https://github.com/toweringcloud/cartoonize-gpt/blob/main/app.py"
@@ -158,7 +197,13 @@ with st.sidebar:
     st.write(f"[![Repo]({badge_link})]({github_link})")
 
 
-if not IMAGE_API_KEY:
+# Trace Stages of the latest Action (upload, analysis, inference, download)
+tracing.session_trace()
+
+# Show Queue Position while a Backend is at its Limit
+admission.show_waits()
+
+if IMAGE_INPUT == "url" and not IMAGE_API_KEY:
     st.error("Please input your Cloudflare API Token on runtime configuration")
 elif not GPT_API_KEY1:
     st.error("Please input your OpenAI API Key on runtime configuration")
@@ -168,24 +213,13 @@ else:
     # User Input Conditions
     input_condition = selected_input.split(" | ")[1]
     drawing_style = selected_style.split(" | ")
-    drawing_style_name = (
-        "free" if drawing_style[1] == "User Prompt" else drawing_style[1]
-    )
+    drawing_style_name = cartoonize.get_style_name(selected_style)
     upload_file_size_limit = 5 * 1024 * 1024
 
     # Define Assistant Prompt
-    assistant_prompt = ""
-    if drawing_style[1] == "Pixar":
-        assistant_prompt = "3D animation"
-    elif drawing_style[1] == "Studio Ghibli":
-        assistant_prompt = "hand-drawn pastel tones"
-    elif drawing_style[1] == "Marvel Hero":
-        assistant_prompt = "powerful superhero character"
+    assistant_prompt = cartoonize.get_assistant_prompt(selected_style)
 
     if input_condition == "photo by replicate":
-        # Define Replicate API Client
-        replicate.client = replicate.Client(api_token=GPT_API_KEY2)
-
         # Accept User's Prompt
         uploaded_file = st.file_uploader(
             "Upload your photo.", type=["jpg", "png", "jpeg"]
@@ -204,71 +238,145 @@ else:
             if uploaded_file.size > upload_file_size_limit:
                 st.warning("File size exceeds 5MB. Try again.")
             else:
-                # Load Original Image
-                image = Image.open(uploaded_file)
+                # Decode a display-sized Preview (full decode waits for the upload)
+                preview = prepare_preview(uploaded_file)
+
+                # Define Replicate API Client
+                replicate_client = get_replicate_client(GPT_API_KEY2)
 
                 # Show Original Image
-                st.image(image, caption="Original Image", use_container_width=True)
+                st.image(preview, caption="Original Image", use_container_width=True)
 
                 # Action to Cartoonize
                 if st.button("Cartoonize your Photo"):
-                    # Upload Image on Cloudflare Storage
+                    tracing.session_trace(new=True)
+                    photo_hash = hash_bytes(uploaded_file.getvalue())
+                    styles = selected_styles if generate_all else [selected_style]
+                    style_inputs = {
+                        style: cartoonize.get_replicate_input(
+                            style,
+                            user_prompt,
+                            selected_change,
+                            selected_scale,
+                            selected_ratio.split(" | ")[1],
+                        )
+                        for style in styles
+                    }
+
+                    # Reuse Result of the same Photo, Style & Parameters
+                    style_keys = {
+                        style: cartoonize.get_replicate_key(
+                            GPT_MODEL2, photo_hash, style, style_inputs[style]
+                        )
+                        for style in styles
+                    }
+                    style_results = {}
+                    for style in styles:
+                        cartoon_image = (
+                            result_cache.get(style_keys[style])
+                            if reuse_results
+                            else None
+                        )
+                        if cartoon_image:
+                            style_results[style] = {
+                                "image": cartoon_image,
+                                "caption": f"{cartoonize.get_style_name(style)} style of cartoon{', ' + user_prompt if len(user_prompt) > 5 else ''}",
+                            }
+                    drop_results("replicate")
+                    st.session_state.pop("replicate_error", None)
+
                     image_url = None
-                    with st.spinner("Uploading..."):
-                        image_url = upload_image_to_storage(uploaded_file)
-
-                    # if img_b64:
-                    if image_url:
-                        prompt_plus = f"""
-                            A cartoon version of the input image, maintaining the same pose, background and facial expression. 
-                            Clean lines, bright colors, {drawing_style_name} style, but with the original subject's identity preserved. 
-                            {assistant_prompt if len(assistant_prompt) > 0 else ""}
-                            {user_prompt if len(user_prompt) > 5 else ""}
-                        """
-                        prompt_minus = "disfigured, kitsch, ugly, oversaturated, greain, low-res, deformed, blurry, bad anatomy, poorly drawn face, mutation, mutated, extra limb, poorly drawn hands, missing limb, floating limbs, disconnected limbs, malformed hands, blur, out of focus, long neck, long body, disgusting, poorly drawn, childish, mutilated, mangled, old, surreal, calligraphy, sign, writing, watermark, text, body out of frame, extra legs, extra arms, extra feet, out of frame, poorly drawn feet, cross-eye"
-
-                        # Transform custom image & prompt into cartoon using img2img model
-                        cartoon_url = None
-                        with st.spinner("Transforming..."):
-                            output = replicate.run(
-                                GPT_MODEL2,
-                                input={
-                                    "image": image_url,
-                                    "prompt": prompt_plus,
-                                    "negative_prompt": prompt_minus,
-                                    "prompt_strength": selected_change,
-                                    "strength": selected_change,
-                                    "guidance_scale": selected_scale,
-                                    "output_quality": 90,
-                                    "num_inference_steps": 30,
-                                    "num_outputs": 1,
-                                    "aspect_ratio": selected_ratio.split(" | ")[1],
-                                },
+                    if len(style_results) < len(styles):
+                        # Inline or Upload Image for Replicate (once for all styles)
+                        with st.spinner("Uploading..."):
+                            upload_image = prepare_upload(
+                                uploaded_file,
+                                aspect_ratio=selected_ratio.split(" | ")[1],
+                                quality=IMAGE_QUALITY,
                             )
-                            cartoon_url = (
-                                str(output[0])
-                                if isinstance(output, list)
-                                else str(output)
+                            st.caption(f"📦 Optimized: {upload_image.summary()}")
+                            image_url = widgets.get_image_input(upload_image)
+
+                    if generate_all:
+                        # Transform all missing Styles concurrently
+                        def transform_style(style):
+                            return {
+                                "image": cartoonize.transform_by_replicate(
+                                    replicate_client,
+                                    GPT_MODEL2,
+                                    image_url,
+                                    style_inputs[style],
+                                    style_keys[style],
+                                ),
+                                "caption": f"{cartoonize.get_style_name(style)} style of cartoon",
+                            }
+
+                        if image_url:
+                            missing_styles = [
+                                style for style in styles if style not in style_results
+                            ]
+                            fanout_results, fanout_errors = widgets.run_style_fanout(
+                                missing_styles, transform_style
                             )
-
-                        # Show Transformed Image
-                        if cartoon_url:
-                            st.image(
-                                cartoon_url,
-                                caption=f"{drawing_style_name} style of cartoon{', ' + user_prompt if len(user_prompt) > 5 else ''}",
-                                use_container_width=True,
+                            style_results.update(fanout_results)
+                            save_errors("replicate", fanout_errors)
+                            keep_results(
+                                style_results,
+                                "replicate",
+                                GPT_MODEL2,
+                                style_inputs,
+                                user_prompt,
+                                tracing.current_trace().seconds,
                             )
-                            # Download Cartoon Images
-                            st.download_button(
-                                "Download",
-                                data=requests.get(cartoon_url).content,
-                                file_name="converted-s1.png",
+                        save_results("replicate", style_results)
+                        # Redraw from the Session (an upload error stays on the page)
+                        if image_url:
+                            st.rerun()
+                    elif style_results:
+                        save_results("replicate", style_results)
+                    elif image_url:
+                        # Start Transformation (custom image & prompt) using img2img model
+                        try:
+                            prediction_id = jobs.start_prediction(
+                                replicate_client,
+                                GPT_MODEL2,
+                                {"image": image_url, **style_inputs[selected_style]},
+                                style_keys[selected_style],
                             )
+                            st.session_state.replicate_job = {
+                                "id": prediction_id,
+                                "key": style_keys[selected_style],
+                                "model": GPT_MODEL2,
+                                "style": selected_style,
+                                "started": time.time(),
+                                "caption": f"{drawing_style_name} style of cartoon{', ' + user_prompt if len(user_prompt) > 5 else ''}",
+                                "gallery": {
+                                    "user": gallery.session_user(),
+                                    "app": "app.py",
+                                    "style": cartoonize.get_style_name(selected_style),
+                                    "prompt": user_prompt,
+                                    "params": style_inputs[selected_style],
+                                },
+                            }
+                        except admission.Overloaded as e:
+                            st.warning(f"🚦 {e}")
+                        except resilience.upstream_errors() as e:
+                            st.error(f"Failed to transform: {e}")
 
-    elif input_condition == "photo by openai":
-        # Define OpenAI API Client
-        client = openai.OpenAI(api_key=GPT_API_KEY1)
+                # Track Transformation in the Background
+                if "replicate_job" in st.session_state:
+                    widgets.watch_replicate_job(replicate_client)
 
+                if "replicate_error" in st.session_state:
+                    st.error(f"Failed to transform: {st.session_state.replicate_error}")
+                widgets.show_style_errors(load_errors("replicate"))
+
+                # Show Transformed Images (fetched once, kept in the session)
+                replicate_results = load_results("replicate")
+                if replicate_results:
+                    show_style_results(replicate_results, "converted-s1")
+
+    elif input_condition == "photo by openai":
         # Accept User's Prompt
         uploaded_file = st.file_uploader(
             "Upload your photo.", type=["jpg", "png", "jpeg"]
@@ -279,82 +387,145 @@ else:
             if uploaded_file.size > upload_file_size_limit:
                 st.warning("File size exceeds 5MB. Try again.")
             else:
-                # Load Original Image
-                image = Image.open(uploaded_file)
+                # Decode a display-sized Preview (full decode waits for the upload)
+                preview = prepare_preview(uploaded_file)
+
+                # Define OpenAI API Client
+                client = get_openai_client(GPT_API_KEY1)
 
                 # Show Original Image
-                st.image(image, caption="Original Image", use_container_width=True)
+                st.image(preview, caption="Original Image", use_container_width=True)
 
                 # Action to Cartoonize
                 if st.button("Cartoonize your Photo"):
-                    # 1. 이미지 base64로 변환
-                    buffered = io.BytesIO()
-                    image.save(buffered, format="JPEG")
-                    img_bytes = buffered.getvalue()
-                    img_base64 = base64.b64encode(img_bytes).decode()
-
-                    # 2. GPT-4o로 이미지 분석 및 프롬프트 생성
-                    with st.spinner("Analyzing..."):
-                        response = client.chat.completions.create(
-                            model="gpt-4o",
-                            messages=[
-                                {
-                                    "role": "system",
-                                    "content": "You are a visual AI assistant that describes people in cartoon style.",
-                                },
-                                {
-                                    "role": "user",
-                                    "content": [
-                                        {
-                                            "type": "text",
-                                            "text": f"""
-                                                A cartoon version of the input image, maintaining the same pose, background and facial expression. 
-                                                {drawing_style_name} style, but with the original subject's identity preserved. 
-                                                {assistant_prompt if len(assistant_prompt) > 0 else ""}
-                                                Generate a prompt to turn them into a cartoon.
-                                            """,
-                                        },
-                                        {
-                                            "type": "image_url",
-                                            "image_url": {
-                                                "url": f"data:image/jpeg;base64,{img_base64}"
-                                            },
-                                        },
-                                    ],
-                                },
-                            ],
-                            max_tokens=300,
+                    tracing.session_trace(new=True)
+                    photo_hash = hash_bytes(uploaded_file.getvalue())
+                    styles = selected_styles if generate_all else [selected_style]
+                    image_size = selected_ratio.split(" | ")[1]
+                    drop_results("openai")
+
+                    # Reuse Result (and its Prompt) of the same Photo & Style
+                    style_keys = {
+                        style: cartoonize.get_openai_key(
+                            GPT_MODEL1, photo_hash, style, image_size
                         )
-                        cartoon_prompt = response.choices[0].message.content
-
-                    # 3. DALL·E 3 API로 이미지 생성
-                    with st.spinner("Transforming..."):
-                        response = client.images.generate(
-                            model=GPT_MODEL1,
-                            size=selected_ratio.split(" | ")[1],
-                            prompt=cartoon_prompt,
-                            n=1,
+                        for style in styles
+                    }
+                    style_results = {}
+                    for style in styles:
+                        cartoon_image = (
+                            result_cache.get(style_keys[style])
+                            if reuse_results
+                            else None
                         )
-                        cartoon_url = response.data[0].url
-
-                    if cartoon_url:
-                        # Show Transformed Image
-                        st.image(
-                            cartoon_url,
-                            caption=f"[{drawing_style[1]}] {cartoon_prompt}",
-                            use_container_width=True,
+                        cartoon_prompt = result_cache.get_text(
+                            make_key(style_keys[style], "prompt")
                         )
-                        # Download Cartoon Images
-                        st.download_button(
-                            "Download",
-                            data=requests.get(cartoon_url).content,
-                            file_name="converted-s2.png",
+                        if cartoon_image and cartoon_prompt:
+                            style_results[style] = {
+                                "image": cartoon_image,
+                                "caption": f"[{style.split(' | ')[1]}] {cartoon_prompt}",
+                            }
+
+                    if len(style_results) < len(styles):
+                        # Reuse Prompt of the same Photo & Style (skips the analysis)
+                        missing_styles = [
+                            style for style in styles if style not in style_results
+                        ]
+                        prompt_keys = {
+                            style: cartoonize.get_prompt_key(
+                                photo_hash, style, GPT_VISION_DETAIL
+                            )
+                            for style in missing_styles
+                        }
+
+                        # 1. 이미지 축소 후 base64로 변환 (프롬프트가 없을 때만)
+                        img_base64 = None
+                        if any(
+                            result_cache.get_text(prompt_key) is None
+                            for prompt_key in prompt_keys.values()
+                        ):
+                            img_base64 = cartoonize.encode_photo(
+                                open_image(uploaded_file), GPT_VISION_DETAIL
+                            )
+
+                        if generate_all:
+                            # Transform all missing Styles concurrently
+                            def transform_style(style):
+                                cartoon_image, cartoon_prompt = (
+                                    cartoonize.transform_by_openai(
+                                        client,
+                                        GPT_MODEL1,
+                                        img_base64,
+                                        style,
+                                        image_size,
+                                        style_keys[style],
+                                        GPT_VISION_DETAIL,
+                                        prompt_keys[style],
+                                    )
+                                )
+                                return {
+                                    "image": cartoon_image,
+                                    "caption": f"[{style.split(' | ')[1]}] {cartoon_prompt}",
+                                }
+
+                            fanout_results, fanout_errors = widgets.run_style_fanout(
+                                missing_styles, transform_style
+                            )
+                            style_results.update(fanout_results)
+                            save_errors("openai", fanout_errors)
+                        else:
+                            # 2. GPT-4o로 이미지 분석 및 프롬프트 생성
+                            try:
+                                with st.spinner("Analyzing..."):
+                                    cartoon_prompt = cartoonize.describe_photo(
+                                        client,
+                                        img_base64,
+                                        selected_style,
+                                        GPT_VISION_DETAIL,
+                                        prompt_keys[selected_style],
+                                    )
+
+                                # 3. DALL·E 3 API로 이미지 생성
+                                with st.spinner("Transforming..."):
+                                    cartoon_image = cartoonize.draw_cartoon(
+                                        client,
+                                        GPT_MODEL1,
+                                        cartoon_prompt,
+                                        image_size,
+                                        style_keys[selected_style],
+                                    )
+                                style_results[selected_style] = {
+                                    "image": cartoon_image,
+                                    "caption": f"[{drawing_style[1]}] {cartoon_prompt}",
+                                }
+                            except admission.Overloaded as e:
+                                st.warning(f"🚦 {e}")
+                            except resilience.upstream_errors() as e:
+                                st.error(f"Failed to transform: {e}")
+
+                        keep_results(
+                            style_results,
+                            "openai",
+                            GPT_MODEL1,
+                            {
+                                style: {"size": image_size, "detail": GPT_VISION_DETAIL}
+                                for style in styles
+                            },
+                            seconds=tracing.current_trace().seconds,
                         )
 
-    else:
-        # Define OpenAI API Client
-        client = openai.OpenAI(api_key=GPT_API_KEY1)
+                    save_results("openai", style_results)
+                    if generate_all:
+                        st.rerun()
+
+                # Show Transformed Images (fetched once, kept in the session)
+                widgets.show_style_errors(load_errors("openai"))
+                openai_results = load_results("openai")
+                if openai_results:
+                    show_style_results(openai_results, "converted-s2")
 
+    else:
         # Accept User's Prompt
         user_prompt = st.text_input("Enter your prompt (at least 10 characters):")
 
@@ -377,33 +548,77 @@ else:
             if len(user_prompt) >= 10:
                 # Action to Cartoonize
                 if st.button("Cartoonize your Prompt"):
-                    # Transform custom prompt into cartoon using dall-e-3
-                    cartoon_url = None
-                    with st.spinner("Transforming..."):
-                        response = client.images.generate(
-                            model=GPT_MODEL1,
-                            size=selected_ratio.split(" | ")[1],
-                            prompt=f"""
-                                {drawing_style_name} style of cartoon, 
-                                {assistant_prompt if len(assistant_prompt) > 0 else ""}
-                                {user_prompt}
-                            """,
-                            n=1,
-                        )
-                        cartoon_url = response.data[0].url
-
-                    if cartoon_url:
-                        # Show Transformed Image
-                        st.image(
-                            cartoon_url,
-                            caption=f"[{drawing_style[0]}] {user_prompt}",
-                            use_container_width=True,
-                        )
-                        # Download Cartoon Image
-                        st.download_button(
-                            "Download",
-                            data=requests.get(cartoon_url).content,
-                            file_name="converted-s3.png",
+                    tracing.session_trace(new=True)
+                    # Define OpenAI API Client
+                    client = get_openai_client(GPT_API_KEY1)
+
+                    cartoon_prompt = f"""
+                        {drawing_style_name} style of cartoon, 
+                        {assistant_prompt if len(assistant_prompt) > 0 else ""}
+                        {user_prompt}
+                    """
+
+                    # Reuse Result of the same Prompt & Size
+                    result_key = make_key(
+                        GPT_MODEL1, cartoon_prompt, selected_ratio.split(" | ")[1]
+                    )
+                    cartoon_image = (
+                        result_cache.get(result_key) if reuse_results else None
+                    )
+
+                    if cartoon_image is None:
+                        # Transform custom prompt into cartoon using dall-e-3
+                        try:
+                            with st.spinner("Transforming..."), admission.admit(
+                                "openai"
+                            ), tracing.span("inference", "openai", GPT_MODEL1):
+                                response = resilience.call(
+                                    "images",
+                                    "openai",
+                                    lambda timeout: client.with_options(
+                                        timeout=timeout, max_retries=0
+                                    ).images.generate(
+                                        model=GPT_MODEL1,
+                                        size=selected_ratio.split(" | ")[1],
+                                        prompt=cartoon_prompt,
+                                        n=1,
+                                        **cartoonize.image_response_options(GPT_MODEL1),
+                                    ),
+                                )
+                                cartoon_image = cartoonize.read_image_response(response)
+                                result_cache.set(result_key, cartoon_image)
+                        except admission.Overloaded as e:
+                            st.warning(f"🚦 {e}")
+                        except resilience.upstream_errors() as e:
+                            st.error(f"Failed to transform: {e}")
+
+                    if cartoon_image:
+                        results = {
+                            selected_style: {
+                                "image": cartoon_image,
+                                "caption": f"[{drawing_style[0]}] {user_prompt}",
+                            }
+                        }
+                        keep_results(
+                            results,
+                            "openai",
+                            GPT_MODEL1,
+                            {selected_style: {"size": selected_ratio.split(" | ")[1]}},
+                            cartoon_prompt,
+                            tracing.current_trace().seconds,
                         )
+                        save_results("prompt", results)
+
+                # Show Transformed Image (fetched once, kept in the session)
+                prompt_results = load_results("prompt")
+                if prompt_results:
+                    show_style_results(prompt_results, "converted-s3")
             else:
                 st.error("⚠️ Please enter at least 10 characters.")
+
+# Show past Generations (thumbnails first, full size on demand)
+gallery.show_gallery(gallery.session_user())
+
+# Show Stage Timings
+if show_timings:
+    tracing.show_trace(tracing.current_trace())
@@ -1,8 +1,10 @@
-from dotenv import dotenv_values
-from PIL import Image
-from requests_toolbelt.multipart.encoder import MultipartEncoder
-import requests
+from clients import load_config
+from preprocess import UPLOAD_QUALITY, prepare_preview, prepare_upload
+import admission
+import cartoonize
+import gallery
 import streamlit as st
+import tracing
 
 
 # Streamlit App UI
@@ -13,16 +15,23 @@ st.set_page_config(
 st.title("Cartoonize")
 
 
-# Load Configuration
-if "CLOUDFLARE_ACCOUNT_ID" in st.secrets:
-    IMAGE_ACCOUNT_ID = st.secrets["CLOUDFLARE_ACCOUNT_ID"]
-    IMAGE_API_URL = st.secrets["CLOUDFLARE_API_URL"]
-    IMAGE_API_KEY = st.secrets["CLOUDFLARE_API_TOKEN_IMAGES"]
-else:
-    config = dotenv_values(".env")
-    IMAGE_ACCOUNT_ID = config["CLOUDFLARE_ACCOUNT_ID"]
-    IMAGE_API_URL = config["CLOUDFLARE_API_URL"]
-    IMAGE_API_KEY = config["CLOUDFLARE_API_TOKEN_IMAGES"]
+# Load Configuration (read once per process)
+config = load_config()
+IMAGE_ACCOUNT_ID = config.get("CLOUDFLARE_ACCOUNT_ID")
+IMAGE_API_URL = config.get("CLOUDFLARE_API_URL")
+IMAGE_API_KEY = config.get("CLOUDFLARE_API_TOKEN_IMAGES")
+IMAGE_QUALITY = int(config.get("UPLOAD_IMAGE_QUALITY", UPLOAD_QUALITY))
+WORKER_URL = config.get(
+    "CLOUDFLARE_WORKER_URL", "https://cartoonize.toweringcloud.workers.dev"
+)
+WORKER_INPUT = config.get("CLOUDFLARE_WORKER_INPUT", cartoonize.WORKER_INPUT)
+
+# Rotation Choices in counterclockwise degrees
+ROTATIONS = {"None": 0, "Left 90": 90, "Right 90": -90}
+
+
+# Expose Stage Metrics (only when METRICS_PORT is configured)
+tracing.start_metrics_server()
 
 
 # Handle OAuth Login
@@ -37,6 +46,9 @@ else:
     st.warning("Check your Account!")
     st.stop()
 
+# Gallery of past Generations (one per account)
+GALLERY_USER = user.get("email") or user.get("name")
+
 with st.sidebar:
     # Cartoon Style
     selected_style = st.selectbox(
@@ -50,6 +62,9 @@ with st.sidebar:
         ),
     )
 
+    # Stage Timings of the latest Action
+    show_timings = st.checkbox("Show stage timings")
+
     # Link to Github Repo
     st.markdown("---")
     github_link = (
@@ -59,26 +74,37 @@ with st.sidebar:
     st.write(f"[![Repo]({badge_link})]({github_link})")
 
 
-def upload_image_to_storage(image_file):
-    encoder = MultipartEncoder(
-        fields={"file": (image_file.name, image_file, "image/jpeg")}
-    )
-    headers = {
-        "Authorization": f"Bearer {IMAGE_API_KEY}",
-        "Content-Type": encoder.content_type,
-    }
-
-    IMAGE_UPLOAD_URL = f"{IMAGE_API_URL}/{IMAGE_ACCOUNT_ID}/images/v1"
-    response = requests.post(IMAGE_UPLOAD_URL, headers=headers, data=encoder)
-
-    if response.status_code == 200:
-        return response.json()["result"]["variants"][0]
-    else:
-        st.error(f"Failed to upload: {response.text}")
+def upload_image_to_storage(image):
+    try:
+        return cartoonize.upload_image_to_storage(
+            image, IMAGE_ACCOUNT_ID, IMAGE_API_URL, IMAGE_API_KEY
+        )
+    except cartoonize.UploadError as e:
+        st.error(f"Failed to upload: {e}")
+        return None
+    except admission.Overloaded as e:
+        st.warning(f"🚦 {e}")
+        return None
+
+
+def transform_by_worker(style, image, image_url=None):
+    try:
+        return cartoonize.transform_by_worker(WORKER_URL, style, image, image_url)
+    except cartoonize.WorkerError:
+        st.error("Failed to transform...😢")
+        return None
+    except admission.Overloaded as e:
+        st.warning(f"🚦 {e}")
         return None
 
 
-if not IMAGE_API_KEY:
+# Trace Stages of the latest Action (upload, inference)
+tracing.session_trace()
+
+# Show Queue Position while a Backend is at its Limit
+admission.show_waits()
+
+if WORKER_INPUT == "url" and not IMAGE_API_KEY:
     st.error("Please input your Cloudflare API Token on runtime configuration")
 else:
     uploaded_file = st.file_uploader("Upload your photo!", type=["jpg", "png", "jpeg"])
@@ -88,50 +114,76 @@ else:
         if uploaded_file.size > 3 * 1024 * 1024:
             st.warning("File size exceeds 3MB. Try again.")
         else:
-            # Load Original Image
-            image = Image.open(uploaded_file)
-
             # Select Image Rataion
-            rotation = st.radio("Image Rotation", ("None", "Left 90", "Right 90"))
-            if rotation == "Left 90":
-                image = image.rotate(90, expand=True)
-            elif rotation == "Right 90":
-                image = image.rotate(-90, expand=True)
+            rotation = st.radio("Image Rotation", tuple(ROTATIONS))
+
+            # Decode a display-sized Preview (full decode waits for the upload)
+            preview = prepare_preview(uploaded_file, ROTATIONS[rotation])
 
             #  Show Original Image
-            st.image(image, caption="Original Image", use_container_width=True)
+            st.image(preview, caption="Original Image", use_container_width=True)
 
             # Action to Cartoonize
             if st.button("Cartoonize"):
-                # Upload Image on Cloudflare Storage
+                tracing.session_trace(new=True)
+                art_style = selected_style.split(" | ")[1]
+
+                # Prepare the rotated Photo once, for a single upload
+                with st.spinner("Preparing..."):
+                    upload_image = prepare_upload(
+                        uploaded_file,
+                        quality=IMAGE_QUALITY,
+                        rotation=ROTATIONS[rotation],
+                    )
+                    st.caption(f"📦 Optimized: {upload_image.summary()}")
+
+                # Upload Image on Cloudflare Storage (url mode only)
                 image_url = None
-                with st.spinner("Uploading..."):
-                    image_url = upload_image_to_storage(uploaded_file)
-
-                if image_url:
-                    st.success("✅ Uploaded!")
+                if WORKER_INPUT == "url":
+                    with st.spinner("Uploading..."):
+                        image_url = upload_image_to_storage(upload_image)
+                    if image_url:
+                        st.success("✅ Uploaded!")
 
+                if image_url or WORKER_INPUT != "url":
                     # Transform Uploaded Image using Cloudflare Workers
-                    art_style = selected_style.split(" | ")[1]
-                    files = {"file": uploaded_file.getvalue(), "style": art_style}
-
                     with st.spinner("Transforming..."):
-                        response = requests.post(
-                            "https://cartoonize.toweringcloud.workers.dev", files=files
+                        cartoon_url = transform_by_worker(
+                            art_style, upload_image, image_url
                         )
 
-                    if response.status_code == 200:
-                        result = response.json()
-                        cartoon_url = result.get("result", {}).get("variants", [])[0]
-
-                        if cartoon_url:
-                            st.success("✅ Transformed!")
-
-                            # Show Transformed Image
-                            st.image(
-                                cartoon_url,
+                    if cartoon_url:
+                        st.success("✅ Transformed!")
+
+                        # Fetch the Result once, for the page and the gallery
+                        # (the browser loads it from the CDN if this fails)
+                        try:
+                            cartoon_image = cartoonize.download_result(cartoon_url)
+                        except cartoonize.DownloadError:
+                            cartoon_image = None
+                        if cartoon_image:
+                            gallery.save(
+                                GALLERY_USER,
+                                "app_cloudflare.py",
+                                cartoon_image,
+                                backend="cloudflare_worker",
+                                model=WORKER_URL,
+                                style=art_style,
                                 caption=f"{art_style} style of cartoon",
-                                use_container_width=True,
+                                params={"input": WORKER_INPUT},
+                                seconds=tracing.current_trace().seconds,
                             )
-                        else:
-                            st.error("Failed to transform...😢")
+
+                        # Show Transformed Image
+                        st.image(
+                            cartoon_image or cartoon_url,
+                            caption=f"{art_style} style of cartoon",
+                            use_container_width=True,
+                        )
+
+# Show past Generations (thumbnails first, full size on demand)
+gallery.show_gallery(GALLERY_USER)
+
+# Show Stage Timings
+if show_timings:
+    tracing.show_trace(tracing.current_trace())
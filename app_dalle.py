@@ -1,6 +1,12 @@
-from dotenv import dotenv_values
-import openai
+from cache import make_key, result_cache
+from clients import get_openai_client, load_config
+from preprocess import OUTPUT_FORMAT, OUTPUT_FORMATS, OUTPUT_QUALITY, prepare_output
+import admission
+import cartoonize
+import gallery
+import resilience
 import streamlit as st
+import tracing
 
 
 # Streamlit App UI
@@ -11,18 +17,18 @@ st.set_page_config(
 st.title("Cartoonize")
 
 
-# Load Configuration
-if "OPENAI_API_KEY" in st.secrets:
-    LOGIN_ID = st.secrets["CUSTOM_LOGIN_ID"]
-    LOGIN_PW = st.secrets["CUSTOM_LOGIN_PW"]
-    API_KEY = st.secrets["OPENAI_API_KEY"]
-    GPT_MODEL = st.secrets["OPENAI_MODEL_DRAW"]
-else:
-    config = dotenv_values(".env")
-    LOGIN_ID = config["CUSTOM_LOGIN_ID"]
-    LOGIN_PW = config["CUSTOM_LOGIN_PW"]
-    API_KEY = config["OPENAI_API_KEY"]
-    GPT_MODEL = config["OPENAI_MODEL_DRAW"]
+# Load Configuration (read once per process)
+config = load_config()
+LOGIN_ID = config.get("CUSTOM_LOGIN_ID")
+LOGIN_PW = config.get("CUSTOM_LOGIN_PW")
+API_KEY = config.get("OPENAI_API_KEY")
+GPT_MODEL = config.get("OPENAI_MODEL_DRAW")
+OUTPUT_FORMAT = config.get("OUTPUT_IMAGE_FORMAT", OUTPUT_FORMAT)
+OUTPUT_QUALITY = int(config.get("OUTPUT_IMAGE_QUALITY", OUTPUT_QUALITY))
+
+
+# Expose Stage Metrics (only when METRICS_PORT is configured)
+tracing.start_metrics_server()
 
 
 def login():
@@ -73,6 +79,12 @@ with st.sidebar:
         ),
     )
 
+    # Result Cache (turn off for a fresh variation of the same input)
+    reuse_results = st.checkbox("Reuse previous results", value=True)
+
+    # Stage Timings of the latest Action
+    show_timings = st.checkbox("Show stage timings")
+
     # Link to Github Repo
     st.markdown("---")
     github_link = "https://github.com/toweringcloud/cartoonize-gpt/blob/main/app.py"
@@ -80,12 +92,15 @@ with st.sidebar:
     st.write(f"[![Repo]({badge_link})]({github_link})")
 
 
+# Trace Stages of the latest Action (inference, download)
+tracing.session_trace()
+
+# Show Queue Position while a Backend is at its Limit
+admission.show_waits()
+
 if not API_KEY:
     st.error("Please setup your OpenAI API Key on the runtime configuration")
 else:
-    # Define OpenAI API Client
-    client = openai.OpenAI(api_key=API_KEY)
-
     # Accept User's Prompt
     user_prompt = st.text_input("Enter your prompt (at least 10 characters):")
 
@@ -93,26 +108,83 @@ else:
         if len(user_prompt) >= 10:
             # Action to Cartoonize
             if st.button("Cartoonize"):
-                # Transform Uploaded Image using OpenAI DALL·E API
-                cartoon_url = None
-                with st.spinner("Transforming..."):
-                    art_style = selected_style.split(" | ")
-                    response = client.images.generate(
+                tracing.session_trace(new=True)
+
+                # Define OpenAI API Client
+                client = get_openai_client(API_KEY)
+
+                art_style = selected_style.split(" | ")
+                cartoon_prompt = f"{user_prompt}, {art_style[0]} 스타일로 보여줘~"
+
+                # Reuse Result of the same Prompt & Size
+                result_key = make_key(
+                    GPT_MODEL, cartoon_prompt, selected_size.split(" | ")[1]
+                )
+                cartoon_image = result_cache.get(result_key) if reuse_results else None
+
+                if cartoon_image is None:
+                    # Transform Uploaded Image using OpenAI DALL·E API
+                    try:
+                        with st.spinner("Transforming..."), admission.admit(
+                            "openai"
+                        ), tracing.span("inference", "openai", GPT_MODEL):
+                            response = resilience.call(
+                                "images",
+                                "openai",
+                                lambda timeout: client.with_options(
+                                    timeout=timeout, max_retries=0
+                                ).images.generate(
+                                    model=GPT_MODEL,
+                                    prompt=cartoon_prompt,
+                                    size=selected_size.split(" | ")[1],
+                                    n=1,
+                                    **cartoonize.image_response_options(GPT_MODEL),
+                                ),
+                            )
+                            cartoon_image = cartoonize.read_image_response(response)
+                            result_cache.set(result_key, cartoon_image)
+                    except admission.Overloaded as e:
+                        st.warning(f"🚦 {e}")
+                    except resilience.upstream_errors() as e:
+                        st.error(f"Failed to transform: {e}")
+
+                if cartoon_image:
+                    st.success("✅ Transformed!")
+                    gallery.save(
+                        gallery.session_user(),
+                        "app_dalle.py",
+                        cartoon_image,
+                        backend="openai",
                         model=GPT_MODEL,
-                        prompt=f"{user_prompt}, {art_style[0]} 스타일로 보여줘~",
-                        size=selected_size.split(" | ")[1],
-                        n=1,
+                        style=art_style[1],
+                        prompt=cartoon_prompt,
+                        caption=f"[{art_style[0]}] {user_prompt}",
+                        params={"size": selected_size.split(" | ")[1]},
+                        seconds=tracing.current_trace().seconds,
                     )
-                    cartoon_url = response.data[0].url
-
-                if cartoon_url:
-                    st.success("✅ Transformed!")
 
-                    # Show Transformed Image
+                    # Show Transformed Image, compactly encoded for the browser
+                    output, output_format = prepare_output(
+                        cartoon_image, OUTPUT_FORMAT, OUTPUT_QUALITY
+                    )
+                    _, mime, extension = OUTPUT_FORMATS[output_format]
                     st.image(
-                        cartoon_url,
+                        output,
                         caption=f"[{art_style[0]}] {user_prompt}",
                         use_container_width=True,
                     )
+                    st.download_button(
+                        "Download",
+                        data=output,
+                        file_name=f"converted-{art_style[1].lower()}.{extension}",
+                        mime=mime,
+                    )
         else:
             st.error("⚠️ Please enter at least 10 characters.")
+
+# Show past Generations (thumbnails first, full size on demand)
+gallery.show_gallery(gallery.session_user())
+
+# Show Stage Timings
+if show_timings:
+    tracing.show_trace(tracing.current_trace())
@@ -1,9 +1,12 @@
-from diffusers import StableDiffusionControlNetPipeline, ControlNetModel
-from dotenv import dotenv_values
-from PIL import Image
-import openai
+from clients import get_openai_client, load_config
+from preprocess import fit_control_image, open_image, prepare_preview
+from results import drop_results, load_results, save_results
+import gallery
+import inference
+import resilience
 import streamlit as st
-import torch
+import time
+import tracing
 
 
 # Streamlit App UI
@@ -14,16 +17,20 @@ st.set_page_config(
 st.title("Cartoonize")
 
 
-# Load Configuration
-if "OPENAI_API_KEY" in st.secrets:
-    LANGUAGE = st.secrets["CUSTOM_LANGUAGE"]
-    API_KEY = st.secrets["OPENAI_API_KEY"]
-    GPT_MODEL = st.secrets["OPENAI_MODEL_DRAW"]
-else:
-    config = dotenv_values(".env")
-    LANGUAGE = config["CUSTOM_LANGUAGE"]
-    API_KEY = config["OPENAI_API_KEY"]
-    GPT_MODEL = config["OPENAI_MODEL_DRAW"]
+# Load Configuration (read once per process)
+config = load_config()
+LANGUAGE = config.get("CUSTOM_LANGUAGE")
+API_KEY = config.get("OPENAI_API_KEY")
+GPT_MODEL = config.get("OPENAI_MODEL_DRAW")
+SOCKET = config.get("DIFFUSERS_SOCKET", inference.SOCKET_PATH)
+PREVIEW_EVERY = int(config.get("DIFFUSERS_PREVIEW_EVERY", 5))
+
+# Rotation Choices in counterclockwise degrees
+ROTATIONS = {"None": 0, "Left 90°": 90, "Right 90°": -90}
+
+
+# Expose Stage Metrics (only when METRICS_PORT is configured)
+tracing.start_metrics_server()
 
 
 with st.sidebar:
@@ -39,6 +46,9 @@ with st.sidebar:
         ),
     )
 
+    # Stage Timings of the latest Action
+    show_timings = st.checkbox("Show stage timings")
+
     # Link to Github Repo
     st.markdown("---")
     github_link = (
@@ -48,12 +58,76 @@ with st.sidebar:
     st.write(f"[![Repo]({badge_link})]({github_link})")
 
 
+@st.fragment(run_every=1)
+def watch_generation():
+    job = st.session_state.get("diffusers_job")
+    if not job:
+        return
+    tracing.session_trace()
+
+    # Stream the latest Latent Preview while the pipeline keeps denoising
+    generation = job["generation"]
+    if not generation.done:
+        if generation.step:
+            st.info(f"⏳ Transforming... (step {generation.step}/{generation.steps})")
+        else:
+            st.info("⏳ Waiting for the engine...")
+        if generation.preview is not None:
+            st.image(
+                generation.preview,
+                caption="Preview (approximate)",
+                use_container_width=True,
+            )
+        if st.button("Cancel", key="cancel_diffusers_job"):
+            generation.cancel()
+            del st.session_state.diffusers_job
+            tracing.record_span(
+                "inference",
+                time.time() - job["started"],
+                "diffusers",
+                job["model"],
+                outcome="canceled",
+            )
+            st.rerun()
+        return
+
+    del st.session_state.diffusers_job
+    tracing.record_span(
+        "inference",
+        time.time() - job["started"],
+        "diffusers",
+        job["model"],
+        outcome="error" if generation.error else "ok",
+    )
+
+    if generation.error:
+        st.session_state.diffusers_error = generation.error
+    elif generation.result:
+        gallery.save(
+            gallery.session_user(),
+            "app_diffusers.py",
+            generation.result,
+            backend="diffusers",
+            model=job["model"],
+            style=job["style"],
+            prompt=job["prompt"],
+            caption=job["caption"],
+            params={"steps": generation.steps},
+            seconds=time.time() - job["started"],
+        )
+        save_results(
+            "diffusers",
+            {job["style"]: {"image": generation.result, "caption": job["caption"]}},
+        )
+    st.rerun()
+
+
+# Trace Stages of the latest Action (inference, description)
+tracing.session_trace()
+
 if not API_KEY:
     st.error("Please input your Replicate API Token on runtime configuration")
 else:
-    # Define OpenAI API Client
-    client = openai.OpenAI(api_key=API_KEY)
-
     uploaded_file = st.file_uploader("Upload your photo.", type=["jpg", "png", "jpeg"])
 
     if uploaded_file is not None:
@@ -61,59 +135,100 @@ else:
         if uploaded_file.size > 3 * 1024 * 1024:
             st.warning("File size exceeds 3MB. Try again.")
         else:
-            # Load Original Image
-            image = Image.open(uploaded_file)
-
             # Select Image Rataion
-            rotation = st.radio(
-                "Rotate your photo, if necessary.", ("None", "Left 90°", "Right 90°")
-            )
-            if rotation == "Left 90°":
-                image = image.rotate(90, expand=True)
-            elif rotation == "Right 90°":
-                image = image.rotate(-90, expand=True)
+            rotation = st.radio("Rotate your photo, if necessary.", tuple(ROTATIONS))
+
+            # Decode a display-sized Preview (full decode waits for the upload)
+            preview = prepare_preview(uploaded_file, ROTATIONS[rotation])
 
             #  Show Original Image
-            st.image(image, caption="Original Image", use_container_width=True)
+            st.image(preview, caption="Original Image", use_container_width=True)
 
             # Action to Cartoonize
             if st.button("Cartoonize"):
-                # Transform Uploaded Image using OpenAI DALL·E API
-                cartoon_url = None
-                with st.spinner("Transforming..."):
-                    # Load ControlNet Model
-                    controlnet = ControlNetModel.from_pretrained(
-                        "lllyasviel/control_v11f1e_sd15_tile"
+                tracing.session_trace(new=True)
+                drop_results("diffusers")
+                st.session_state.pop("diffusers_error", None)
+                st.session_state.pop("diffusers_description", None)
+                if "diffusers_job" in st.session_state:
+                    st.session_state.pop("diffusers_job")["generation"].cancel()
+
+                # Queue Transformation in the Inference Worker, which holds the
+                # one pipeline shared by every replica and batches their requests
+                # (of one bucket size, so the photo is fitted to one first)
+                art_style = selected_style.split(" | ")[1]
+                prompt = f"high quality, {art_style} cartoon style"
+                try:
+                    generation = inference.submit(
+                        prompt,
+                        fit_control_image(
+                            open_image(uploaded_file, ROTATIONS[rotation])
+                        ),
+                        PREVIEW_EVERY,
+                        SOCKET,
                     )
-
-                    # Setup Stable Diffusion Pipeline
-                    pipe = StableDiffusionControlNetPipeline.from_pretrained(
-                        "runwayml/stable-diffusion-v1-5",
-                        controlnet=controlnet,
-                        torch_dtype=torch.float16,
-                    ).to("cuda")
-
-                    # Run Transformation with Prompt
-                    art_style = selected_style.split(" | ")[1]
-                    prompt = (f"high quality, {art_style} cartoon style",)
-                    cartoon_url = pipe(prompt=prompt, image=image).images[0]
-
-                if cartoon_url:
-                    st.success("✅ Transformed!")
-
-                    # Show Transformed Image
-                    st.image(
-                        cartoon_url,
-                        caption=f"{art_style} style of cartoon",
-                        use_container_width=True,
+                except inference.QueueFull:
+                    st.warning("The engine is busy. Try again in a moment.")
+                except inference.WorkerUnavailable as e:
+                    st.error(
+                        f"The inference worker is not running (python inference_worker.py): {e}"
                     )
+                else:
+                    st.session_state.diffusers_job = {
+                        "generation": generation,
+                        "model": generation.model,
+                        "style": art_style,
+                        "prompt": prompt,
+                        "caption": f"{art_style} style of cartoon",
+                        "started": time.time(),
+                    }
+
+            if "diffusers_job" in st.session_state:
+                watch_generation()
+
+            if "diffusers_error" in st.session_state:
+                st.error(f"Failed to transform: {st.session_state.diffusers_error}")
+
+            # Show Transformed Image (kept in the session, survives reruns)
+            diffusers_results = load_results("diffusers")
+            if diffusers_results:
+                result = next(iter(diffusers_results.values()))
+                st.success("✅ Transformed!")
+                st.image(
+                    result["image"],
+                    caption=result["caption"],
+                    use_container_width=True,
+                )
+
+                # Describe the Result once per transformation
+                if "diffusers_description" not in st.session_state:
+                    # Define OpenAI API Client
+                    client = get_openai_client(API_KEY)
 
                     # Generate Summary on Image using LangChain
-                    description_prompt = f"Describe this cartoon-style image ({cartoon_url}) briefly in {LANGUAGE}.)"
-                    description = client.chat.completions.create(
-                        model=GPT_MODEL,
-                        messages=[{"role": "system", "content": description_prompt}],
-                    )
-
-                    st.success("✅ Described!")
-                    st.write(description.choices[0].message.content)
+                    description_prompt = f"Describe this cartoon-style image ({result['caption']}) briefly in {LANGUAGE}.)"
+                    with tracing.span("analysis", "openai", GPT_MODEL):
+                        description = resilience.call(
+                            "analysis",
+                            "openai",
+                            lambda timeout: client.with_options(
+                                timeout=timeout, max_retries=0
+                            ).chat.completions.create(
+                                model=GPT_MODEL,
+                                messages=[
+                                    {"role": "system", "content": description_prompt}
+                                ],
+                            ),
+                        )
+                    message = description.choices[0].message
+                    st.session_state.diffusers_description = message.content
+
+                st.success("✅ Described!")
+                st.write(st.session_state.diffusers_description)
+
+# Show past Generations (thumbnails first, full size on demand)
+gallery.show_gallery(gallery.session_user())
+
+# Show Stage Timings
+if show_timings:
+    tracing.show_trace(tracing.current_trace())
@@ -1,9 +1,22 @@
-from dotenv import dotenv_values
-from PIL import Image
-from requests_toolbelt.multipart.encoder import MultipartEncoder
-import replicate
-import requests
+from cache import hash_bytes, make_key, result_cache
+from clients import get_replicate_client, load_config
+from preprocess import UPLOAD_QUALITY, prepare_preview, prepare_upload
+from results import (
+    drop_results,
+    load_errors,
+    load_results,
+    save_errors,
+    save_results,
+)
+import admission
+import cartoonize
+import gallery
+import jobs
+import resilience
 import streamlit as st
+import time
+import tracing
+import widgets
 
 
 # Streamlit App UI
@@ -14,34 +27,45 @@ st.set_page_config(
 st.title("Cartoonize")
 
 
-# Load Configuration
-if "REPLICATE_API_TOKEN" in st.secrets:
-    IMAGE_ACCOUNT_ID = st.secrets["CLOUDFLARE_ACCOUNT_ID"]
-    IMAGE_API_URL = st.secrets["CLOUDFLARE_API_URL"]
-    IMAGE_API_KEY = st.secrets["CLOUDFLARE_API_TOKEN_IMAGES"]
-    GPT_API_KEY = st.secrets["REPLICATE_API_TOKEN"]
-    GPT_MODEL = st.secrets["REPLICATE_MODEL_DRAW"]
-else:
-    config = dotenv_values(".env")
-    IMAGE_ACCOUNT_ID = config["CLOUDFLARE_ACCOUNT_ID"]
-    IMAGE_API_URL = config["CLOUDFLARE_API_URL"]
-    IMAGE_API_KEY = config["CLOUDFLARE_API_TOKEN_IMAGES"]
-    GPT_API_KEY = config["REPLICATE_API_TOKEN"]
-    GPT_MODEL = config["REPLICATE_MODEL_DRAW"]
+# Load Configuration (read once per process)
+config = load_config()
+IMAGE_API_KEY = config.get("CLOUDFLARE_API_TOKEN_IMAGES")
+IMAGE_INPUT = config.get("REPLICATE_IMAGE_INPUT", cartoonize.REPLICATE_INPUT)
+IMAGE_QUALITY = int(config.get("UPLOAD_IMAGE_QUALITY", UPLOAD_QUALITY))
+GPT_API_KEY = config.get("REPLICATE_API_TOKEN")
+GPT_MODEL = config.get("REPLICATE_MODEL_DRAW")
+
+CARTOON_STYLES = (
+    "디즈니 | Disney",
+    "픽사 | Pixar",
+    "지브리 | Studio Ghibli",
+    "마블 | Marvel Hero",
+    "아이돌 | K-Pop Star",
+)
+
+# Rotation Choices in counterclockwise degrees
+ROTATIONS = {"None": 0, "Left 90°": 90, "Right 90°": -90}
+
+# Expose Stage Metrics (only when METRICS_PORT is configured)
+tracing.start_metrics_server()
 
 
 with st.sidebar:
     # Cartoon Style
-    selected_style = st.selectbox(
-        "Choose a Cartoon Style",
-        (
-            "디즈니 | Disney",
-            "픽사 | Pixar",
-            "지브리 | Studio Ghibli",
-            "마블 | Marvel Hero",
-            "아이돌 | K-Pop Star",
-        ),
-    )
+    selected_style = st.selectbox("Choose a Cartoon Style", CARTOON_STYLES)
+
+    # Multi-Style Mode (one upload, all styles transformed concurrently)
+    generate_all = st.toggle("Generate all selected styles")
+    if generate_all:
+        selected_styles = st.multiselect(
+            "Choose Cartoon Styles", CARTOON_STYLES, default=CARTOON_STYLES
+        )
+
+    # Result Cache (turn off for a fresh variation of the same input)
+    reuse_results = st.checkbox("Reuse previous results", value=True)
+
+    # Stage Timings of the latest Action
+    show_timings = st.checkbox("Show stage timings")
 
     # Link to Github Repo
     st.markdown("---")
@@ -52,26 +76,42 @@ with st.sidebar:
     st.write(f"[![Repo]({badge_link})]({github_link})")
 
 
-def upload_image_to_storage(image_file):
-    encoder = MultipartEncoder(
-        fields={"file": (image_file.name, image_file, "image/jpeg")}
-    )
-    headers = {
-        "Authorization": f"Bearer {IMAGE_API_KEY}",
-        "Content-Type": encoder.content_type,
+def get_model_input(style):
+    art_style = style.split(" | ")[1]
+    return {
+        "prompt": f"A cartoon version of this image, high quality, digital art, {art_style} style",
+        "prompt_strength": 0.8,
+        "guidance_scale": 7.5,
+        "num_inference_steps": 25,
+        "num_outputs": 1,
+        "output_quality": 90,
     }
 
-    IMAGE_UPLOAD_URL = f"{IMAGE_API_URL}/{IMAGE_ACCOUNT_ID}/images/v1"
-    response = requests.post(IMAGE_UPLOAD_URL, headers=headers, data=encoder)
 
-    if response.status_code == 200:
-        return response.json()["result"]["variants"][0]
-    else:
-        st.error(f"Failed to upload: {response.text}")
-        return None
+def keep_results(results, style_inputs, seconds=None):
+    # Persist Results in the Session's Gallery (no login in this app)
+    for style, result in results.items():
+        gallery.save(
+            gallery.session_user(),
+            "app_replicate.py",
+            result["image"],
+            backend="replicate",
+            model=GPT_MODEL,
+            style=style.split(" | ")[1],
+            prompt=style_inputs[style]["prompt"],
+            caption=result["caption"],
+            params=style_inputs[style],
+            seconds=seconds,
+        )
 
 
-if not IMAGE_API_KEY:
+# Trace Stages of the latest Action (upload, inference, download)
+tracing.session_trace()
+
+# Show Queue Position while a Backend is at its Limit
+admission.show_waits()
+
+if IMAGE_INPUT == "url" and not IMAGE_API_KEY:
     st.error("Please input your Cloudflare API Token on runtime configuration")
 elif not GPT_API_KEY:
     st.error("Please input your Replicate API Token on runtime configuration")
@@ -83,57 +123,145 @@ else:
         if uploaded_file.size > 3 * 1024 * 1024:
             st.warning("File size exceeds 3MB. Try again.")
         else:
-            # Load Original Image
-            image = Image.open(uploaded_file)
+            # Define Replicate API Client
+            replicate_client = get_replicate_client(GPT_API_KEY)
 
             # Select Image Rataion
-            rotation = st.radio(
-                "Rotate your photo, if necessary.", ("None", "Left 90°", "Right 90°")
-            )
-            if rotation == "Left 90°":
-                image = image.rotate(90, expand=True)
-            elif rotation == "Right 90°":
-                image = image.rotate(-90, expand=True)
+            rotation = st.radio("Rotate your photo, if necessary.", tuple(ROTATIONS))
+
+            # Decode a display-sized Preview (full decode waits for the upload)
+            preview = prepare_preview(uploaded_file, ROTATIONS[rotation])
 
             # Show Original Image
-            st.image(image, caption="Original Image", use_container_width=True)
+            st.image(preview, caption="Original Image", use_container_width=True)
 
             # Action to Cartoonize
             if st.button("Cartoonize"):
-                # Upload Image on Cloudflare Storage
+                tracing.session_trace(new=True)
+                photo_hash = hash_bytes(uploaded_file.getvalue())
+                styles = selected_styles if generate_all else [selected_style]
+                style_inputs = {style: get_model_input(style) for style in styles}
+
+                # Reuse Result of the same Photo, Rotation, Style & Parameters
+                style_keys = {
+                    style: make_key(
+                        GPT_MODEL, photo_hash, ROTATIONS[rotation], style_inputs[style]
+                    )
+                    for style in styles
+                }
+                style_results = {}
+                for style in styles:
+                    cartoon_image = (
+                        result_cache.get(style_keys[style]) if reuse_results else None
+                    )
+                    if cartoon_image:
+                        style_results[style] = {
+                            "image": cartoon_image,
+                            "caption": f"{style.split(' | ')[1]} style of cartoon",
+                        }
+                drop_results("replicate")
+                st.session_state.pop("replicate_error", None)
+
                 image_url = None
-                with st.spinner("Uploading..."):
-                    image_url = upload_image_to_storage(uploaded_file)
-
-                # if img_b64:
-                if image_url:
-                    st.success("✅ Uploaded!")
-
-                    # Transform Uploaded Image using Replicate API (Stable Diffusion img2img)
-                    cartoon_url = None
-                    with st.spinner("Transforming..."):
-                        art_style = selected_style.split(" | ")[1]
-                        replicate.client = replicate.Client(api_token=GPT_API_KEY)
-                        output = replicate.run(
-                            GPT_MODEL,
-                            input={
-                                "image": image_url,
-                                "prompt": f"A cartoon version of this image, high quality, digital art, {art_style} style",
-                                "prompt_strength": 0.8,
-                                "guidance_scale": 7.5,
-                                "num_inference_steps": 25,
-                                "num_outputs": 1,
-                                "output_quality": 90,
-                            },
+                if len(style_results) < len(styles):
+                    # Inline or Upload Image for Replicate (once for all styles)
+                    with st.spinner("Uploading..."):
+                        upload_image = prepare_upload(
+                            uploaded_file,
+                            quality=IMAGE_QUALITY,
+                            rotation=ROTATIONS[rotation],
                         )
-                        cartoon_url = output[0].url
+                        st.caption(f"📦 Optimized: {upload_image.summary()}")
+                        image_url = widgets.get_image_input(upload_image)
 
-                    if cartoon_url:
-                        st.success("✅ Transformed!")
+                    # if img_b64:
+                    if image_url:
+                        st.success("✅ Uploaded!")
 
-                        # Show Transformed Image
-                        st.image(
-                            cartoon_url,
-                            caption=f"{art_style} style of cartoon",
-                            use_container_width=True,
+                if generate_all:
+                    # Transform all missing Styles concurrently
+                    def transform_style(style):
+                        return {
+                            "image": cartoonize.transform_by_replicate(
+                                replicate_client,
+                                GPT_MODEL,
+                                image_url,
+                                style_inputs[style],
+                                style_keys[style],
+                            ),
+                            "caption": f"{style.split(' | ')[1]} style of cartoon",
+                        }
+
+                    if image_url:
+                        missing_styles = [
+                            style for style in styles if style not in style_results
+                        ]
+                        fanout_results, fanout_errors = widgets.run_style_fanout(
+                            missing_styles, transform_style
+                        )
+                        style_results.update(fanout_results)
+                        save_errors("replicate", fanout_errors)
+                        keep_results(
+                            style_results, style_inputs, tracing.current_trace().seconds
+                        )
+                    save_results("replicate", style_results)
+                    # Redraw from the Session (an upload error stays on the page)
+                    if image_url:
+                        st.rerun()
+                elif style_results:
+                    save_results("replicate", style_results)
+                elif image_url:
+                    # Start Transformation using Replicate API (Stable Diffusion img2img)
+                    try:
+                        prediction_id = jobs.start_prediction(
+                            replicate_client,
+                            GPT_MODEL,
+                            {"image": image_url, **style_inputs[selected_style]},
+                            style_keys[selected_style],
                         )
+                        st.session_state.replicate_job = {
+                            "id": prediction_id,
+                            "key": style_keys[selected_style],
+                            "model": GPT_MODEL,
+                            "style": selected_style,
+                            "started": time.time(),
+                            "caption": f"{selected_style.split(' | ')[1]} style of cartoon",
+                            "gallery": {
+                                "user": gallery.session_user(),
+                                "app": "app_replicate.py",
+                                "style": selected_style.split(" | ")[1],
+                                "prompt": style_inputs[selected_style]["prompt"],
+                                "params": style_inputs[selected_style],
+                            },
+                        }
+                    except admission.Overloaded as e:
+                        st.warning(f"🚦 {e}")
+                    except resilience.upstream_errors() as e:
+                        st.error(f"Failed to transform: {e}")
+
+            # Track Transformation in the Background
+            if "replicate_job" in st.session_state:
+                widgets.watch_replicate_job(replicate_client)
+
+            if "replicate_error" in st.session_state:
+                st.error(f"Failed to transform: {st.session_state.replicate_error}")
+            widgets.show_style_errors(load_errors("replicate"))
+
+            # Show Transformed Images (fetched once, kept in the session)
+            replicate_results = load_results("replicate")
+            if replicate_results:
+                st.success("✅ Transformed!")
+                columns = st.columns(2 if len(replicate_results) > 1 else 1)
+                for i, result in enumerate(replicate_results.values()):
+                    columns[i % 2].image(
+                        result["image"],
+                        caption=result["caption"],
+                        use_container_width=True,
+                    )
+
+# Show past Generations (thumbnails first, full size on demand)
+gallery.show_gallery(gallery.session_user())
+
+# Show Stage Timings
+if show_timings:
+    tracing.show_trace(tracing.current_trace())
@@ -0,0 +1,207 @@
+from benchmarks.harness import TOLERANCE, load_baseline, measure, report, save_baseline
+from cache import CACHE_DIR
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import time
+
+
+BASELINE = os.path.join(os.path.dirname(__file__), "baseline_diffusers.json")
+
+# Tiny random-weight Models with the SD 1.5 layout, built locally (no Hub download),
+# so every profile runs in seconds on a CPU
+TINY_MODEL_DIR = os.path.join(CACHE_DIR, "bench_diffusers")
+TINY_SEED = 0
+
+IMAGE_SIZE = 64
+
+
+def build_tiny_models(path=TINY_MODEL_DIR):
+    from diffusers import (
+        AutoencoderKL,
+        ControlNetModel,
+        DDIMScheduler,
+        StableDiffusionPipeline,
+        UNet2DConditionModel,
+    )
+    from transformers import CLIPTextConfig, CLIPTextModel, CLIPTokenizer
+    from transformers.models.clip.tokenization_clip import bytes_to_unicode
+    import torch
+
+    model_path = os.path.join(path, "stable-diffusion")
+    controlnet_path = os.path.join(path, "controlnet")
+    if os.path.exists(os.path.join(model_path, "model_index.json")):
+        return model_path, controlnet_path
+
+    torch.manual_seed(TINY_SEED)
+    unet = UNet2DConditionModel(
+        block_out_channels=(32, 64),
+        layers_per_block=2,
+        sample_size=32,
+        down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"),
+        up_block_types=("CrossAttnUpBlock2D", "UpBlock2D"),
+        cross_attention_dim=32,
+    )
+    # Four VAE blocks keep SD's 8x latent scale, which the ControlNet embedding expects
+    vae = AutoencoderKL(
+        block_out_channels=(32, 32, 64, 64),
+        down_block_types=("DownEncoderBlock2D",) * 4,
+        up_block_types=("UpDecoderBlock2D",) * 4,
+        latent_channels=4,
+    )
+    text_encoder = CLIPTextModel(
+        CLIPTextConfig(
+            hidden_size=32,
+            intermediate_size=37,
+            num_attention_heads=4,
+            num_hidden_layers=5,
+            vocab_size=1000,
+            bos_token_id=0,
+            pad_token_id=1,
+            eos_token_id=2,
+        )
+    )
+
+    # Byte-level Vocabulary without merges (one token per character)
+    tokenizer_path = os.path.join(path, "tokenizer-source")
+    os.makedirs(tokenizer_path, exist_ok=True)
+    vocab = {"<|startoftext|>": 0, "!": 1, "<|endoftext|>": 2}
+    for character in bytes_to_unicode().values():
+        vocab.setdefault(character, len(vocab))
+        vocab.setdefault(f"{character}</w>", len(vocab))
+    with open(os.path.join(tokenizer_path, "vocab.json"), "w") as f:
+        json.dump(vocab, f)
+    with open(os.path.join(tokenizer_path, "merges.txt"), "w") as f:
+        f.write("#version: 0.2\n")
+    tokenizer = CLIPTokenizer(
+        os.path.join(tokenizer_path, "vocab.json"),
+        os.path.join(tokenizer_path, "merges.txt"),
+        pad_token="!",
+        model_max_length=77,
+    )
+
+    StableDiffusionPipeline(
+        vae=vae,
+        text_encoder=text_encoder,
+        tokenizer=tokenizer,
+        unet=unet,
+        scheduler=DDIMScheduler(
+            beta_start=0.00085,
+            beta_end=0.012,
+            beta_schedule="scaled_linear",
+            clip_sample=False,
+            set_alpha_to_one=False,
+            steps_offset=1,
+        ),
+        safety_checker=None,
+        feature_extractor=None,
+        requires_safety_checker=False,
+    ).save_pretrained(model_path)
+    ControlNetModel.from_unet(unet).save_pretrained(controlnet_path)
+    return model_path, controlnet_path
+
+
+def run_profile(name, args):
+    # One process per profile: threads, compiled graphs and RSS never leak across
+    from PIL import Image
+    import diffusion
+
+    device = diffusion.select_device(args.device)
+    profile = diffusion.get_profile(name, device, args.steps, args.threads)
+
+    started = time.perf_counter()
+    pipe = diffusion.get_pipeline(
+        args.model, args.controlnet, args.dtype, device, profile
+    )
+    load_seconds = time.perf_counter() - started
+
+    image = Image.new("RGB", (IMAGE_SIZE, IMAGE_SIZE), (200, 120, 80))
+
+    def generate():
+        generations = [
+            diffusion.Generation(
+                "high quality, Disney cartoon style", image, profile, preview_every=0
+            )
+            for _ in range(args.batch)
+        ]
+        diffusion.run_batch(pipe, generations)
+        for generation in generations:
+            if generation.error:
+                raise RuntimeError(generation.error)
+
+    result = measure(generate, args.repeat)
+    return {
+        **result,
+        "seconds": result["seconds"] / args.batch,
+        "load_seconds": load_seconds,
+        "steps": profile.steps,
+        "max_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Compare the diffusers performance profiles on a small model"
+    )
+    parser.add_argument("-p", "--profile", action="append", default=[])
+    parser.add_argument("-r", "--repeat", type=int, default=3)
+    parser.add_argument("--model", help="pipeline id or path (the tiny one by default)")
+    parser.add_argument("--controlnet", help="ControlNet id or path")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--dtype", default="auto")
+    parser.add_argument("-b", "--batch", type=int, default=1, help="images per call")
+    parser.add_argument("--steps", type=int, help="override every profile's steps")
+    parser.add_argument("--threads", type=int, help="override every profile's threads")
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+    parser.add_argument(
+        "--save", action="store_true", help="store the results as the new baseline"
+    )
+    args = parser.parse_args(argv)
+
+    import diffusion
+
+    if not args.model or not args.controlnet:
+        tiny_model, tiny_controlnet = build_tiny_models()
+        args.model = args.model or tiny_model
+        args.controlnet = args.controlnet or tiny_controlnet
+
+    # LoRA profiles only fit full-size SD 1.5 weights, so they run on request
+    profiles = args.profile or [
+        name for name, profile in diffusion.PROFILES.items() if not profile.lora
+    ]
+    context = multiprocessing.get_context("spawn")
+
+    results = {}
+    for name in profiles:
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            key = name if args.batch == 1 else f"{name}/batch{args.batch}"
+            results[key] = executor.submit(run_profile, name, args).result()
+
+    baseline = load_baseline(args.baseline)
+    regressions = report(results, baseline, args.tolerance)
+
+    print(
+        f"\n{'profile':16} {'steps':>5} {'load s':>8} {'s/image':>8} {'peak RSS MB':>12}"
+    )
+    for name, result in results.items():
+        print(
+            f"{name:16} {result['steps']:5} {result['load_seconds']:8.2f} "
+            f"{result['seconds']:8.2f} {result['max_rss_bytes'] / 1024 / 1024:12.0f}"
+        )
+
+    if args.save:
+        save_baseline(args.baseline, {**baseline, **results})
+        print(f"baseline saved: {args.baseline}")
+        return 0
+
+    for name, metric, base, current in regressions:
+        print(f"❌ {name} {metric}: {base:,.4g} → {current:,.4g}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
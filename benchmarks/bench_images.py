@@ -0,0 +1,132 @@
+from benchmarks.fixtures import FIXTURES, make_photo
+from benchmarks.harness import add_arguments, run
+from cartoonize import PhotoFile, download_result, encode_photo, find_photos
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from PIL import Image
+from preprocess import prepare_output, prepare_preview, prepare_upload, rotate
+from requests_toolbelt.multipart.encoder import MultipartEncoder
+import argparse
+import io
+import os
+import tempfile
+import threading
+
+
+BASELINE = os.path.join(os.path.dirname(__file__), "baseline_images.json")
+
+
+def write_fixtures(directory):
+    paths = []
+    for name, size, image_format, orientation in FIXTURES:
+        extension = "jpg" if image_format == "JPEG" else "png"
+        path = os.path.join(directory, f"{name}.{extension}")
+        with open(path, "wb") as f:
+            f.write(make_photo(size, image_format, orientation))
+        paths.append(path)
+    return paths
+
+
+# Local CDN serving the fixtures as "results" (no network involved)
+class FixtureHandler(BaseHTTPRequestHandler):
+    files = {}
+
+    def do_GET(self):
+        data = self.files.get(self.path)
+        if data is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_fixture_server(photos):
+    FixtureHandler.files = {
+        f"/{os.path.basename(photo)}": PhotoFile(photo).getvalue() for photo in photos
+    }
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FixtureHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}"
+
+
+def photo_benchmarks(photo, base_url):
+    name = os.path.splitext(os.path.basename(photo))[0]
+    data = PhotoFile(photo).getvalue()
+    image = Image.open(io.BytesIO(data))
+    image.load()
+    prepared = prepare_upload(PhotoFile(photo))
+    buffered = io.BytesIO()
+    image.convert("RGB").save(buffered, format="PNG")
+    result = buffered.getvalue()
+
+    def decode():
+        Image.open(io.BytesIO(data)).load()
+
+    def rotate_photo():
+        rotate(image, 90)
+
+    def preview():
+        prepare_preview(io.BytesIO(data), rotation=90)
+
+    def vision_encode():
+        encode_photo(image)
+
+    def upload_encode():
+        prepare_upload(PhotoFile(photo))
+
+    def multipart():
+        encoder = MultipartEncoder(
+            fields={"file": (prepared.name, prepared.data, "image/jpeg")}
+        )
+        encoder.read()
+
+    def download_decode():
+        result = download_result(f"{base_url}/{os.path.basename(photo)}")
+        Image.open(io.BytesIO(result)).load()
+
+    def output_encode(output_format):
+        # Bypass the memoized result, so every repeat encodes
+        return lambda: prepare_output.__wrapped__(result, output_format)
+
+    return {
+        f"{name}/decode": decode,
+        f"{name}/rotate": rotate_photo,
+        f"{name}/preview": preview,
+        f"{name}/vision_encode": vision_encode,
+        f"{name}/upload_encode": upload_encode,
+        f"{name}/multipart": multipart,
+        f"{name}/download_decode": download_decode,
+        **{
+            f"{name}/output_{output_format}": output_encode(output_format)
+            for output_format in ("webp", "avif", "jpeg")
+        },
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the image handling hot paths"
+    )
+    parser.add_argument(
+        "--photos", help="photo directory or manifest (default: synthetic fixtures)"
+    )
+    add_arguments(parser, BASELINE)
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as directory:
+        photos = find_photos(args.photos) if args.photos else write_fixtures(directory)
+        base_url = start_fixture_server(photos)
+
+        benchmarks = {}
+        for photo in photos:
+            benchmarks.update(photo_benchmarks(photo, base_url))
+        return run(benchmarks, args)
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,171 @@
+from benchmarks.harness import (
+    TOLERANCE,
+    format_change,
+    is_regression,
+    load_baseline,
+    save_baseline,
+)
+from collections import defaultdict
+from statistics import median
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE = os.path.join(os.path.dirname(__file__), "baseline_imports.json")
+
+APPS = (
+    "app.py",
+    "app_replicate.py",
+    "app_cloudflare.py",
+    "app_dalle.py",
+    "app_diffusers.py",
+)
+
+# Heavy Backends that should stay out of the first page render
+BACKENDS = (
+    "openai",
+    "replicate",
+    "requests_toolbelt",
+    "httpx",
+    "PIL",
+    "torch",
+    "diffusers",
+)
+
+# First render of a script through AppTest, under -X importtime
+PROBE = """
+import sys
+sys.path.insert(0, {repo_dir!r})
+from streamlit.testing.v1 import AppTest
+at = AppTest.from_file({script!r}, default_timeout=300)
+at.session_state.logged_in = {logged_in!r}
+at.run()
+"""
+
+# Placeholder Keys, so the logged-in page gets past its configuration checks
+DUMMY_ENV = """\
+CLOUDFLARE_API_TOKEN_IMAGES=dummy
+OPENAI_API_KEY=dummy
+REPLICATE_API_TOKEN=dummy
+TRACE_FILE=
+"""
+
+# Pages measured per app: the login page of a fresh session, then the main page
+PAGES = ("login", "main")
+
+
+def import_times(script, cwd, logged_in=False):
+    # Self time (seconds) of every module imported while rendering the script
+    probe = PROBE.format(repo_dir=REPO_DIR, script=script, logged_in=logged_in)
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", probe],
+        cwd=cwd,
+        capture_output=True,
+        text=True,
+    )
+    modules = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, _, name = line[len("import time:") :].split("|")
+        modules[name.strip()] = int(self_us) / 1_000_000
+    return modules
+
+
+def measure_page(script, page, empty_modules, repeat, cwd):
+    # Only modules beyond what AppTest imports to render an empty page count
+    totals = []
+    packages = defaultdict(list)
+    for _ in range(repeat):
+        modules = import_times(os.path.join(REPO_DIR, script), cwd, page == "main")
+        app_modules = {
+            name: seconds
+            for name, seconds in modules.items()
+            if name not in empty_modules
+        }
+        totals.append(sum(app_modules.values()))
+
+        per_package = defaultdict(float)
+        for name, seconds in app_modules.items():
+            per_package[name.split(".")[0]] += seconds
+        for package, seconds in per_package.items():
+            packages[package].append(seconds)
+
+    return {
+        "seconds": median(totals),
+        "backends": [backend for backend in BACKENDS if backend in packages],
+        "top": sorted(
+            ((package, median(times)) for package, times in packages.items()),
+            key=lambda item: item[1],
+            reverse=True,
+        )[:5],
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Measure the import cost of each app's first page render"
+    )
+    parser.add_argument("-r", "--repeat", type=int, default=3)
+    parser.add_argument("-k", "--filter", default="", help="run matching apps")
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+    parser.add_argument(
+        "--save", action="store_true", help="store the results as the new baseline"
+    )
+    args = parser.parse_args(argv)
+
+    baseline = load_baseline(args.baseline)
+    results = {}
+    regressions = []
+    with tempfile.TemporaryDirectory() as directory:
+        empty_script = os.path.join(directory, "empty.py")
+        with open(empty_script, "w") as f:
+            f.write("import streamlit as st\n")
+        with open(os.path.join(directory, ".env"), "w") as f:
+            f.write(DUMMY_ENV)
+        empty_modules = import_times(empty_script, directory)
+
+        print(
+            f"{'app (page)':28} {'import ms':>10} {'vs base':>8}  "
+            "backends loaded / heaviest packages"
+        )
+        for script in APPS:
+            if args.filter not in script:
+                continue
+            for page in PAGES:
+                name = f"{script} ({page})"
+                result = measure_page(
+                    script, page, empty_modules, args.repeat, directory
+                )
+                results[name] = {"seconds": result["seconds"]}
+
+                base = baseline.get(name, {}).get("seconds")
+                print(
+                    f"{name:28} {result['seconds'] * 1000:10.0f} "
+                    f"{format_change(base, result['seconds']):>8}  "
+                    f"{', '.join(result['backends']) or '-'} / "
+                    + ", ".join(
+                        f"{package} {seconds * 1000:.0f}ms"
+                        for package, seconds in result["top"]
+                    )
+                )
+                if is_regression("seconds", base, result["seconds"], args.tolerance):
+                    regressions.append((name, base, result["seconds"]))
+
+    if args.save:
+        save_baseline(args.baseline, {**baseline, **results})
+        print(f"baseline saved: {args.baseline}")
+        return 0
+
+    for name, base, current in regressions:
+        print(f"❌ {name} import time: {base * 1000:.0f}ms → {current * 1000:.0f}ms")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
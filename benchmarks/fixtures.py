@@ -0,0 +1,33 @@
+from PIL import Image
+import io
+
+
+# Synthetic Fixture Photos (name, size, format, EXIF orientation)
+FIXTURES = (
+    ("small-jpeg", (640, 480), "JPEG", None),
+    ("phone-jpeg", (4032, 3024), "JPEG", 6),
+    ("medium-png", (2048, 1536), "PNG", None),
+    ("transparent-png", (1200, 1200), "RGBA", None),
+)
+
+
+def make_photo(size, image_format, orientation=None):
+    # Gradients plus noise, so encoders work about as hard as on a real photo
+    gradient = Image.linear_gradient("L").resize(size)
+    noise = Image.effect_noise(size, 48)
+    image = Image.merge(
+        "RGB", (gradient, noise, gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT))
+    )
+
+    buffered = io.BytesIO()
+    if image_format == "RGBA":
+        image.putalpha(Image.radial_gradient("L").resize(size))
+        image.save(buffered, format="PNG")
+    elif image_format == "JPEG":
+        exif = Image.Exif()
+        if orientation:
+            exif[0x0112] = orientation
+        image.save(buffered, format="JPEG", quality=92, exif=exif)
+    else:
+        image.save(buffered, format=image_format)
+    return buffered.getvalue()
@@ -0,0 +1,162 @@
+from statistics import median
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+
+# Regression Thresholds (relative, plus an absolute floor against timer noise)
+TOLERANCE = 0.25
+MIN_SECONDS_DELTA = 0.002
+MIN_BYTES_DELTA = 256 * 1024
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def current_rss():
+    # Resident set size on Linux (None elsewhere)
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except OSError:
+        return None
+
+
+# Peak RSS growth while a block runs, sampled every millisecond
+class RssSampler:
+
+    def __init__(self, interval=0.001):
+        self.interval = interval
+        self.start_rss = None
+        self.peak_rss = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.start_rss = self.peak_rss = current_rss()
+        if self.start_rss is not None:
+            self._thread = threading.Thread(target=self._sample, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self.peak_rss = max(self.peak_rss, current_rss())
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak_rss = max(self.peak_rss, current_rss())
+
+    @property
+    def growth(self):
+        if self.start_rss is None:
+            return None
+        return self.peak_rss - self.start_rss
+
+
+def measure(func, repeat=5):
+    # Warm up once, keep the median of the timed runs
+    func()
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - started)
+
+    # Pillow's pixel buffers live outside tracemalloc, so RSS growth is kept too
+    tracemalloc.start()
+    try:
+        with RssSampler() as sampler:
+            func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "seconds": median(times),
+        "peak_bytes": peak,
+        "peak_rss_bytes": sampler.growth,
+    }
+
+
+def load_baseline(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_baseline(path, results):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+def is_regression(metric, base, current, tolerance):
+    if base is None or current is None:
+        return False
+    floor = MIN_SECONDS_DELTA if metric == "seconds" else MIN_BYTES_DELTA
+    return current > base * (1 + tolerance) and current - base > floor
+
+
+def format_change(base, current):
+    if not base or current is None:
+        return "-"
+    return f"{(current - base) / base:+.0%}"
+
+
+def report(results, baseline, tolerance=TOLERANCE):
+    regressions = []
+    print(
+        f"{'benchmark':40} {'ms':>9} {'vs base':>8} "
+        f"{'heap KB':>9} {'vs base':>8} {'rss KB':>9}"
+    )
+    for name, result in results.items():
+        base = baseline.get(name, {})
+        rss = result["peak_rss_bytes"]
+        print(
+            f"{name:40} "
+            f"{result['seconds'] * 1000:9.2f} "
+            f"{format_change(base.get('seconds'), result['seconds']):>8} "
+            f"{result['peak_bytes'] / 1024:9.0f} "
+            f"{format_change(base.get('peak_bytes'), result['peak_bytes']):>8} "
+            f"{'-' if rss is None else f'{rss / 1024:.0f}':>9}"
+        )
+        for metric in ("seconds", "peak_bytes"):
+            if is_regression(metric, base.get(metric), result[metric], tolerance):
+                regressions.append((name, metric, base[metric], result[metric]))
+    return regressions
+
+
+def add_arguments(parser, baseline):
+    parser.add_argument("-r", "--repeat", type=int, default=5)
+    parser.add_argument("-k", "--filter", default="", help="run matching benchmarks")
+    parser.add_argument("--baseline", default=baseline)
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+    parser.add_argument(
+        "--save", action="store_true", help="store the results as the new baseline"
+    )
+
+
+def run(benchmarks, args):
+    results = {}
+    for name, func in benchmarks.items():
+        if args.filter in name:
+            results[name] = measure(func, args.repeat)
+
+    baseline = load_baseline(args.baseline)
+    regressions = report(results, baseline, args.tolerance)
+
+    if args.save:
+        save_baseline(args.baseline, {**baseline, **results})
+        print(f"baseline saved: {args.baseline}")
+        return 0
+
+    if not baseline:
+        print(f"no baseline at {args.baseline} (run with --save to store one)")
+    for name, metric, base, current in regressions:
+        print(f"❌ {name} {metric}: {base:,.4g} → {current:,.4g}")
+    return 1 if regressions else 0
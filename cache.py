@@ -0,0 +1,102 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+
+CACHE_DIR = os.environ.get("CARTOONIZE_CACHE_DIR", ".cache")
+
+
+def hash_bytes(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def make_key(*parts):
+    payload = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+    return hash_bytes(payload.encode("utf-8"))
+
+
+# Bytes on local disk, one file per key, bounded by age, entry count and size
+# (mtime is refreshed on every hit, so eviction drops least recently used first)
+class DiskCache:
+
+    def __init__(self, name, ttl=None, max_entries=1000, max_bytes=None):
+        self.path = os.path.join(CACHE_DIR, name)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(self.path, exist_ok=True)
+
+    def _file(self, key):
+        return os.path.join(self.path, key)
+
+    def get(self, key):
+        file_path = self._file(key)
+        try:
+            if self.ttl and time.time() - os.path.getmtime(file_path) > self.ttl:
+                os.remove(file_path)
+                return None
+            with open(file_path, "rb") as f:
+                data = f.read()
+            os.utime(file_path)
+            return data
+        except FileNotFoundError:
+            return None
+
+    def set(self, key, data):
+        file_path = self._file(key)
+        temp_path = f"{file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, file_path)
+        self.evict()
+
+    def get_text(self, key):
+        data = self.get(key)
+        return data.decode("utf-8") if data is not None else None
+
+    def set_text(self, key, text):
+        self.set(key, text.encode("utf-8"))
+
+    def delete(self, key):
+        try:
+            os.remove(self._file(key))
+        except FileNotFoundError:
+            pass
+
+    def evict(self):
+        with self._lock:
+            entries = []
+            now = time.time()
+            for entry in os.scandir(self.path):
+                if entry.name.endswith(".tmp"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                if self.ttl and now - stat.st_mtime > self.ttl:
+                    self.delete(entry.name)
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.name))
+
+            entries.sort()
+            total_bytes = sum(size for _, size, _ in entries)
+            while entries and (
+                len(entries) > self.max_entries
+                or (self.max_bytes and total_bytes > self.max_bytes)
+            ):
+                _, size, name = entries.pop(0)
+                self.delete(name)
+                total_bytes -= size
+
+
+# Cloudflare Images variant URL by image content (survives process restarts)
+upload_cache = DiskCache("uploads", ttl=7 * 24 * 60 * 60, max_entries=5000)
+
+# Generated cartoon bytes by input content, style, parameters and model
+result_cache = DiskCache(
+    "results", ttl=30 * 24 * 60 * 60, max_entries=2000, max_bytes=2 * 1024**3
+)
@@ -0,0 +1,653 @@
+from cache import hash_bytes, make_key, result_cache, upload_cache
+from clients import get_openai_client, get_replicate_client, get_session, load_config
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from preprocess import (
+    OUTPUT_FORMATS,
+    UPLOAD_QUALITY,
+    VISION_DETAIL,
+    VISION_DETAILS,
+    prepare_upload,
+    prepare_vision_input,
+)
+from resilience import UpstreamError
+import admission
+import argparse
+import base64
+import io
+import json
+import jobs
+import os
+import resilience
+import threading
+import time
+import tracing
+
+
+CARTOON_STYLES = (
+    "디즈니 | Disney",
+    "픽사 | Pixar",
+    "지브리 | Studio Ghibli",
+    "마블 | Marvel Hero",
+    "아이돌 | K-Pop Star",
+    "미정 | User Prompt",
+)
+
+PHOTO_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+# Result Download Limits
+MAX_DOWNLOAD_BYTES = 20 * 1024 * 1024
+DOWNLOAD_TIMEOUT = (5, 60)
+
+# Replicate Image Input: "url" stores the photo on Cloudflare Images first,
+# "data" inlines it as a data URI, "auto" inlines photos up to INLINE_INPUT_MAX_BYTES
+REPLICATE_INPUTS = ("auto", "data", "url")
+REPLICATE_INPUT = "auto"
+INLINE_INPUT_MAX_BYTES = 1024 * 1024
+
+# Cartoonize Worker Input: "file" posts the prepared photo itself (the worker
+# stores only the result), "url" passes a photo already on Cloudflare Images
+WORKER_INPUTS = ("file", "url")
+WORKER_INPUT = "file"
+
+NEGATIVE_PROMPT = "disfigured, kitsch, ugly, oversaturated, greain, low-res, deformed, blurry, bad anatomy, poorly drawn face, mutation, mutated, extra limb, poorly drawn hands, missing limb, floating limbs, disconnected limbs, malformed hands, blur, out of focus, long neck, long body, disgusting, poorly drawn, childish, mutilated, mangled, old, surreal, calligraphy, sign, writing, watermark, text, body out of frame, extra legs, extra arms, extra feet, out of frame, poorly drawn feet, cross-eye"
+
+
+class UploadError(UpstreamError):
+    pass
+
+
+class DownloadError(UpstreamError):
+    pass
+
+
+class WorkerError(UpstreamError):
+    pass
+
+
+# Local Photo with the interface of Streamlit's UploadedFile (name, getvalue)
+class PhotoFile(io.BytesIO):
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            super().__init__(f.read())
+        self.name = os.path.basename(path)
+
+
+# Token Bucket limiting how often a backend is called (shared by all workers)
+def find_style(name):
+    for style in CARTOON_STYLES:
+        if name.lower() in style.lower():
+            return style
+    raise ValueError(f"Unknown style: {name}")
+
+
+def get_style_name(style):
+    return "free" if style.split(" | ")[1] == "User Prompt" else style.split(" | ")[1]
+
+
+def get_assistant_prompt(style):
+    style = style.split(" | ")[1]
+    if style == "Pixar":
+        return "3D animation"
+    elif style == "Studio Ghibli":
+        return "hand-drawn pastel tones"
+    elif style == "Marvel Hero":
+        return "powerful superhero character"
+    return ""
+
+
+def upload_image_to_storage(image, account_id, api_url, api_key):
+    from requests_toolbelt.multipart.encoder import MultipartEncoder
+
+    # Reuse the stored variant when the same photo was uploaded before
+    image_key = make_key(account_id, hash_bytes(image.data))
+    image_url = upload_cache.get_text(image_key)
+    if image_url:
+        tracing.record_span(
+            "upload", 0, "cloudflare", outcome="cached", bytes_in=image.size
+        )
+        return image_url
+
+    IMAGE_UPLOAD_URL = f"{api_url}/{account_id}/images/v1"
+
+    def upload(timeout):
+        # A fresh encoder per attempt, as each one consumes its stream
+        encoder = MultipartEncoder(
+            fields={"file": (image.name, image.data, "image/jpeg")}
+        )
+        headers = {
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": encoder.content_type,
+        }
+        response = get_session("cloudflare_api").post(
+            IMAGE_UPLOAD_URL, headers=headers, data=encoder, timeout=timeout
+        )
+        if response.status_code != 200:
+            raise UploadError(response.text, response.status_code)
+        return response
+
+    with admission.admit("cloudflare"), tracing.span(
+        "upload", "cloudflare", bytes_in=image.size
+    ) as span:
+        response = resilience.call("upload", "cloudflare", upload)
+        span.bytes_out = len(response.content)
+
+    image_url = response.json()["result"]["variants"][0]
+    upload_cache.set_text(image_key, image_url)
+    return image_url
+
+
+def get_image_input(
+    image,
+    account_id,
+    api_url,
+    api_key,
+    mode=REPLICATE_INPUT,
+    max_inline_bytes=INLINE_INPUT_MAX_BYTES,
+):
+    if mode not in REPLICATE_INPUTS:
+        raise ValueError(f"Unknown Replicate image input: {mode}")
+
+    # Inlining skips the storage upload and Replicate's fetch back from it
+    # ("auto" inlines every photo when no storage token is configured)
+    if mode == "data" or (
+        mode == "auto" and (not api_key or image.size <= max_inline_bytes)
+    ):
+        with tracing.span("upload", "inline", bytes_in=image.size) as span:
+            data_uri = f"data:image/jpeg;base64,{base64.b64encode(image.data).decode()}"
+            span.bytes_out = len(data_uri)
+        return data_uri
+    return upload_image_to_storage(image, account_id, api_url, api_key)
+
+
+def download_result(url, max_bytes=MAX_DOWNLOAD_BYTES):
+    # Stream the Result, refusing anything larger than the cap
+    def download(timeout):
+        with get_session("cdn").get(
+            url, stream=True, timeout=(DOWNLOAD_TIMEOUT[0], timeout)
+        ) as response:
+            if response.status_code >= 400:
+                raise DownloadError(
+                    f"Failed to download {url}: {response.status_code}",
+                    response.status_code,
+                )
+            if int(response.headers.get("Content-Length") or 0) > max_bytes:
+                raise DownloadError(f"Result exceeds {max_bytes} bytes: {url}")
+
+            buffered = io.BytesIO()
+            for chunk in response.iter_content(chunk_size=64 * 1024):
+                buffered.write(chunk)
+                if buffered.tell() > max_bytes:
+                    raise DownloadError(f"Result exceeds {max_bytes} bytes: {url}")
+            return buffered.getvalue()
+
+    with tracing.span("download", "cdn") as span:
+        try:
+            data = resilience.call("download", "cdn", download)
+        except resilience.transient_errors() as e:
+            raise DownloadError(f"Failed to download {url}: {e}") from e
+        span.bytes_out = len(data)
+    return data
+
+
+def image_response_options(model):
+    # DALL·E returns the image inline on request, saving the fetch from its CDN
+    # (gpt-image models always do, and reject the parameter)
+    return {"response_format": "b64_json"} if model.startswith("dall-e") else {}
+
+
+def read_image_response(response):
+    image = response.data[0]
+    if not image.b64_json:
+        return download_result(image.url)
+
+    with tracing.span("download", "inline", bytes_in=len(image.b64_json)) as span:
+        data = base64.b64decode(image.b64_json)
+        span.bytes_out = len(data)
+    return data
+
+
+def transform_by_worker(worker_url, style, image=None, image_url=None):
+    if image_url:
+        request = {"data": {"url": image_url, "style": style}}
+        bytes_in = len(image_url)
+    else:
+        request = {"files": {"file": image.data, "style": style}}
+        bytes_in = image.size
+
+    def transform(timeout):
+        response = get_session("cloudflare_worker").post(
+            worker_url, **request, timeout=timeout
+        )
+        if response.status_code != 200:
+            raise WorkerError(response.text, response.status_code)
+        return response
+
+    with admission.admit("cloudflare_worker"), tracing.span(
+        "inference", "cloudflare_worker", bytes_in=bytes_in
+    ) as span:
+        response = resilience.call("worker", "cloudflare_worker", transform)
+        span.bytes_out = len(response.content)
+
+    variants = response.json().get("result", {}).get("variants", [])
+    if not variants:
+        raise WorkerError("No result variant returned")
+    return variants[0]
+
+
+def get_replicate_input(style, user_prompt, strength, scale, aspect_ratio):
+    assistant_prompt = get_assistant_prompt(style)
+    prompt_plus = f"""
+        A cartoon version of the input image, maintaining the same pose, background and facial expression.
+        Clean lines, bright colors, {get_style_name(style)} style, but with the original subject's identity preserved.
+        {assistant_prompt if len(assistant_prompt) > 0 else ""}
+        {user_prompt if len(user_prompt) > 5 else ""}
+    """
+    return {
+        "prompt": prompt_plus,
+        "negative_prompt": NEGATIVE_PROMPT,
+        "prompt_strength": strength,
+        "strength": strength,
+        "guidance_scale": scale,
+        "output_quality": 90,
+        "num_inference_steps": 30,
+        "num_outputs": 1,
+        "aspect_ratio": aspect_ratio,
+    }
+
+
+def get_replicate_key(model, photo_hash, style, model_input):
+    return make_key(model, photo_hash, get_style_name(style), model_input)
+
+
+def transform_by_replicate(client, model, image_url, model_input, result_key):
+    with admission.admit("replicate"), tracing.span("inference", "replicate", model):
+        prediction = jobs.run_prediction(
+            client, model, {"image": image_url, **model_input}
+        )
+    cartoon_image = download_result(jobs.prediction_output_url(prediction))
+    result_cache.set(result_key, cartoon_image)
+    return cartoon_image
+
+
+def encode_photo(image, detail=VISION_DETAIL):
+    return base64.b64encode(prepare_vision_input(image, detail)).decode()
+
+
+def get_openai_key(model, photo_hash, style, size):
+    return make_key(
+        "gpt-4o",
+        model,
+        photo_hash,
+        get_style_name(style),
+        get_assistant_prompt(style),
+        size,
+    )
+
+
+def get_prompt_key(photo_hash, style, detail):
+    return make_key(
+        "gpt-4o", photo_hash, get_style_name(style), get_assistant_prompt(style), detail
+    )
+
+
+def describe_photo(client, img_base64, style, detail=VISION_DETAIL, prompt_key=None):
+    # Reuse the Prompt already generated for the same Photo & Style
+    if prompt_key:
+        cartoon_prompt = result_cache.get_text(prompt_key)
+        if cartoon_prompt:
+            tracing.record_span("analysis", 0, "openai", "gpt-4o", outcome="cached")
+            return cartoon_prompt
+
+    assistant_prompt = get_assistant_prompt(style)
+    with admission.admit("openai"), tracing.span(
+        "analysis", "openai", "gpt-4o", len(img_base64)
+    ) as span:
+        response = resilience.call(
+            "analysis",
+            "openai",
+            lambda timeout: client.with_options(
+                timeout=timeout, max_retries=0
+            ).chat.completions.create(
+                model="gpt-4o",
+                messages=[
+                    {
+                        "role": "system",
+                        "content": "You are a visual AI assistant that describes people in cartoon style.",
+                    },
+                    {
+                        "role": "user",
+                        "content": [
+                            {
+                                "type": "text",
+                                "text": f"""
+                                A cartoon version of the input image, maintaining the same pose, background and facial expression.
+                                {get_style_name(style)} style, but with the original subject's identity preserved.
+                                {assistant_prompt if len(assistant_prompt) > 0 else ""}
+                                Generate a prompt to turn them into a cartoon.
+                            """,
+                            },
+                            {
+                                "type": "image_url",
+                                "image_url": {
+                                    "url": f"data:image/jpeg;base64,{img_base64}",
+                                    "detail": detail,
+                                },
+                            },
+                        ],
+                    },
+                ],
+                max_tokens=300,
+            ),
+        )
+        cartoon_prompt = response.choices[0].message.content
+        span.bytes_out = len(cartoon_prompt.encode("utf-8"))
+    if prompt_key:
+        result_cache.set_text(prompt_key, cartoon_prompt)
+    return cartoon_prompt
+
+
+def draw_cartoon(client, model, prompt, size, result_key):
+    with admission.admit("openai"), tracing.span(
+        "inference", "openai", model, len(prompt.encode("utf-8"))
+    ):
+        response = resilience.call(
+            "images",
+            "openai",
+            lambda timeout: client.with_options(
+                timeout=timeout, max_retries=0
+            ).images.generate(
+                model=model,
+                size=size,
+                prompt=prompt,
+                n=1,
+                **image_response_options(model),
+            ),
+        )
+    cartoon_image = read_image_response(response)
+    result_cache.set(result_key, cartoon_image)
+    result_cache.set_text(make_key(result_key, "prompt"), prompt)
+    return cartoon_image
+
+
+def transform_by_openai(
+    client,
+    model,
+    img_base64,
+    style,
+    size,
+    result_key,
+    detail=VISION_DETAIL,
+    prompt_key=None,
+):
+    cartoon_prompt = describe_photo(client, img_base64, style, detail, prompt_key)
+    cartoon_image = draw_cartoon(client, model, cartoon_prompt, size, result_key)
+    return cartoon_image, cartoon_prompt
+
+
+def find_photos(source):
+    # Directory of photos, or a manifest listing one photo path per line
+    if os.path.isdir(source):
+        return sorted(
+            os.path.join(root, name)
+            for root, _, names in os.walk(source)
+            for name in names
+            if name.lower().endswith(PHOTO_EXTENSIONS)
+        )
+
+    base_dir = os.path.dirname(os.path.abspath(source))
+    with open(source, encoding="utf-8") as f:
+        lines = [line.strip() for line in f]
+    return [
+        os.path.join(base_dir, line)
+        for line in lines
+        if line and not line.startswith("#")
+    ]
+
+
+def load_progress(progress_path):
+    done = set()
+    if os.path.exists(progress_path):
+        with open(progress_path, encoding="utf-8") as f:
+            for line in f:
+                record = json.loads(line)
+                if record.get("status") == "done":
+                    done.add(
+                        (
+                            record["photo"],
+                            record["style"],
+                            record.get("backend"),
+                            record.get("key"),
+                        )
+                    )
+    return done
+
+
+def get_output_path(output_dir, source, photo, style, backend, result_key, image):
+    from PIL import Image
+
+    # Mirror the photo's place under the source, so equal names never collide;
+    # backend and result key keep runs with other settings apart
+    base_dir = source if os.path.isdir(source) else os.path.dirname(source)
+    relative = os.path.relpath(os.path.abspath(photo), os.path.abspath(base_dir))
+    if relative.startswith(os.pardir):
+        relative = os.path.basename(photo)
+    name = os.path.splitext(relative)[0]
+
+    # Extension of the format actually returned (Replicate sends WebP)
+    image_format = (Image.open(io.BytesIO(image)).format or "png").lower()
+    extension = OUTPUT_FORMATS.get(image_format, ("", "", image_format))[2]
+    return os.path.join(
+        output_dir,
+        f"{name}-{get_style_name(style).lower()}-{backend}-{result_key[:8]}.{extension}",
+    )
+
+
+def run_batch(args):
+    from PIL import Image
+
+    config = load_config()
+    photos = find_photos(args.source)
+    styles = [find_style(name) for name in args.style]
+    os.makedirs(args.output, exist_ok=True)
+    progress_path = args.progress or os.path.join(args.output, "progress.jsonl")
+    image_input = args.image_input or config.get(
+        "REPLICATE_IMAGE_INPUT", REPLICATE_INPUT
+    )
+    max_inline_bytes = int(
+        config.get("REPLICATE_INLINE_MAX_BYTES", INLINE_INPUT_MAX_BYTES)
+    )
+
+    def get_model_input(photo_hash, style):
+        if args.backend == "replicate":
+            model = config.get("REPLICATE_MODEL_ITI")
+            model_input = get_replicate_input(
+                style, args.prompt, args.strength, args.guidance, args.aspect_ratio
+            )
+            return (
+                model,
+                model_input,
+                get_replicate_key(model, photo_hash, style, model_input),
+            )
+        model = config.get("OPENAI_MODEL_TTI")
+        return model, None, get_openai_key(model, photo_hash, style, args.size)
+
+    # Resume: skip photo/style pairs done in a previous run with the same
+    # backend and parameters (the result key covers model and inputs)
+    done = load_progress(progress_path)
+    tasks = []
+    for photo in photos:
+        with open(photo, "rb") as f:
+            photo_hash = hash_bytes(f.read())
+        for style in styles:
+            result_key = get_model_input(photo_hash, style)[2]
+            if (os.path.abspath(photo), style, args.backend, result_key) not in done:
+                tasks.append((photo, style))
+    skipped = len(photos) * len(styles) - len(tasks)
+
+    # A batch waits for its turn: Gates from the flags, with unbounded queues
+    admission.use_limits(
+        {
+            backend: admission.Limit(rate=rate, concurrency=args.concurrency)
+            for backend, rate in (
+                ("cloudflare", args.upload_rate),
+                ("replicate", args.replicate_rate),
+                ("openai", args.openai_rate),
+            )
+        }
+    )
+    progress_lock = threading.Lock()
+    tracing.start_metrics_server()
+
+    def cartoonize_photo(photo, style):
+        photo_file = PhotoFile(photo)
+        photo_hash = hash_bytes(photo_file.getvalue())
+        model, model_input, result_key = get_model_input(photo_hash, style)
+
+        if args.backend == "replicate":
+            cartoon_image = result_cache.get(result_key) if args.reuse else None
+            if cartoon_image is None:
+                upload_image = prepare_upload(
+                    photo_file,
+                    aspect_ratio=args.aspect_ratio,
+                    quality=int(config.get("UPLOAD_IMAGE_QUALITY", UPLOAD_QUALITY)),
+                )
+                image_url = get_image_input(
+                    upload_image,
+                    config.get("CLOUDFLARE_ACCOUNT_ID"),
+                    config.get("CLOUDFLARE_API_URL"),
+                    config.get("CLOUDFLARE_API_TOKEN_IMAGES"),
+                    image_input,
+                    max_inline_bytes,
+                )
+                cartoon_image = transform_by_replicate(
+                    get_replicate_client(config.get("REPLICATE_API_TOKEN")),
+                    model,
+                    image_url,
+                    model_input,
+                    result_key,
+                )
+        else:
+            cartoon_image = result_cache.get(result_key) if args.reuse else None
+            if cartoon_image is None:
+                # Skip the vision input (and analysis) when the Prompt is cached
+                prompt_key = get_prompt_key(photo_hash, style, args.detail)
+                img_base64 = None
+                if result_cache.get_text(prompt_key) is None:
+                    img_base64 = encode_photo(Image.open(photo_file), args.detail)
+                cartoon_image, _ = transform_by_openai(
+                    get_openai_client(config.get("OPENAI_API_KEY")),
+                    model,
+                    img_base64,
+                    style,
+                    args.size,
+                    result_key,
+                    args.detail,
+                    prompt_key,
+                )
+
+        output_path = get_output_path(
+            args.output,
+            args.source,
+            photo,
+            style,
+            args.backend,
+            result_key,
+            cartoon_image,
+        )
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        with open(output_path, "wb") as f:
+            f.write(cartoon_image)
+        return output_path, result_key
+
+    def record(photo, style, status, started, **fields):
+        with progress_lock, open(progress_path, "a", encoding="utf-8") as f:
+            record = {
+                "photo": os.path.abspath(photo),
+                "style": style,
+                "backend": args.backend,
+                "status": status,
+                "seconds": round(time.monotonic() - started, 3),
+                **fields,
+            }
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def process(photo, style):
+        started = time.monotonic()
+        try:
+            output_path, result_key = cartoonize_photo(photo, style)
+        except Exception as e:
+            record(photo, style, "failed", started, error=str(e))
+            raise
+        record(photo, style, "done", started, key=result_key, output=output_path)
+        return time.monotonic() - started
+
+    print(f"{len(tasks)} to cartoonize, {skipped} already done")
+    started = time.monotonic()
+    latencies = []
+    failed = 0
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        futures = {
+            executor.submit(process, photo, style): (photo, style)
+            for photo, style in tasks
+        }
+        for future in as_completed(futures):
+            photo, style = futures[future]
+            try:
+                latencies.append(future.result())
+                print(f"✅ {photo} [{get_style_name(style)}]")
+            except Exception as e:
+                failed += 1
+                print(f"❌ {photo} [{get_style_name(style)}] {e}")
+
+    # Throughput Summary
+    elapsed = time.monotonic() - started
+    print("---")
+    print(f"done: {len(latencies)}, failed: {failed}, skipped: {skipped}")
+    print(f"elapsed: {elapsed:.1f}s")
+    if latencies:
+        print(f"throughput: {len(latencies) / elapsed * 60:.1f} images/min")
+        print(f"latency: {sum(latencies) / len(latencies):.1f}s avg")
+    return 1 if failed else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Cartoonize a directory (or manifest) of photos"
+    )
+    parser.add_argument("source", help="photo directory or manifest file")
+    parser.add_argument("-o", "--output", default="cartoons")
+    parser.add_argument(
+        "-b", "--backend", choices=("replicate", "openai"), default="replicate"
+    )
+    parser.add_argument("-s", "--style", action="append", default=[])
+    parser.add_argument("-c", "--concurrency", type=int, default=4)
+    parser.add_argument("--prompt", default="", help="extra prompt (replicate)")
+    parser.add_argument("--strength", type=float, default=0.75)
+    parser.add_argument("--guidance", type=float, default=10)
+    parser.add_argument("--aspect-ratio", default="1:1")
+    parser.add_argument("--size", default="1024x1024", help="image size (openai)")
+    parser.add_argument(
+        "--image-input",
+        choices=REPLICATE_INPUTS,
+        help="photo as data URI or Cloudflare URL (replicate, default: auto)",
+    )
+    parser.add_argument(
+        "--detail",
+        choices=VISION_DETAILS,
+        default=VISION_DETAIL,
+        help="vision detail (openai)",
+    )
+    parser.add_argument("--upload-rate", type=float, default=0, help="uploads/sec")
+    parser.add_argument("--replicate-rate", type=float, default=0, help="calls/sec")
+    parser.add_argument("--openai-rate", type=float, default=0, help="calls/sec")
+    parser.add_argument(
+        "--progress", help="progress file (default: OUTPUT/progress.jsonl)"
+    )
+    parser.add_argument("--no-reuse", dest="reuse", action="store_false")
+    args = parser.parse_args(argv)
+    args.style = args.style or ["Disney"]
+    return run_batch(args)
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
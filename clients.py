@@ -0,0 +1,131 @@
+from dotenv import dotenv_values
+import contextlib
+import contextvars
+import functools
+import streamlit as st
+
+
+# Upstreams reached through requests, each with its own keep-alive connection pool
+# (OpenAI and Replicate clients keep their own httpx pools)
+UPSTREAMS = ("cloudflare_api", "cloudflare_worker", "cdn")
+
+# Connection Pool Sizes (hosts per pool, sockets kept alive per host)
+POOL_CONNECTIONS = 4
+POOL_MAXSIZE = 16
+
+# Seconds to establish a connection (the read timeout comes from each call's policy)
+CONNECT_TIMEOUT = 5
+
+# Timeout of the Replicate calls made in this context (the SDK has no per-call one)
+_request_timeout = contextvars.ContextVar("request_timeout", default=None)
+
+# HTTP libraries and backend SDKs are imported on first use, so a session only
+# pays the import cost of the input source it actually selects
+
+
+@functools.cache
+def load_config():
+    # Streamlit secrets take precedence over the local .env file
+    config = {
+        key: value for key, value in dotenv_values(".env").items() if value is not None
+    }
+    try:
+        config.update(st.secrets.to_dict())
+    except FileNotFoundError:
+        pass
+    return config
+
+
+def pool_limits():
+    config = load_config()
+    return (
+        int(config.get("HTTP_POOL_CONNECTIONS", POOL_CONNECTIONS)),
+        int(config.get("HTTP_POOL_MAXSIZE", POOL_MAXSIZE)),
+    )
+
+
+@functools.cache
+def get_session(upstream):
+    if upstream not in UPSTREAMS:
+        raise ValueError(f"Unknown upstream: {upstream}")
+
+    from requests.adapters import HTTPAdapter
+    import requests
+
+    pool_connections, pool_maxsize = pool_limits()
+    adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def httpx_limits():
+    import httpx
+
+    _, pool_maxsize = pool_limits()
+    return httpx.Limits(
+        max_connections=pool_maxsize, max_keepalive_connections=pool_maxsize
+    )
+
+
+@functools.cache
+def get_openai_client(api_key):
+    import openai
+
+    return openai.OpenAI(
+        api_key=api_key,
+        base_url=load_config().get("OPENAI_BASE_URL"),
+        http_client=openai.DefaultHttpxClient(limits=httpx_limits()),
+    )
+
+
+@contextlib.contextmanager
+def request_timeout(seconds):
+    token = _request_timeout.set(seconds)
+    try:
+        yield
+    finally:
+        _request_timeout.reset(token)
+
+
+@functools.cache
+def get_replicate_client(api_token):
+    from replicate.client import RetryTransport
+    import httpx
+    import replicate
+
+    class TimeoutTransport(httpx.HTTPTransport):
+        # Apply the timeout of the calling step to each request
+        def handle_request(self, request):
+            seconds = _request_timeout.get()
+            if seconds is not None:
+                request.extensions["timeout"] = httpx.Timeout(
+                    seconds, connect=min(seconds, CONNECT_TIMEOUT)
+                ).as_dict()
+            return super().handle_request(request)
+
+    client = replicate.Client(
+        api_token=api_token,
+        base_url=load_config().get("REPLICATE_API_URL"),
+        transport=TimeoutTransport(limits=httpx_limits()),
+    )
+    # resilience.call retries every Replicate call, so the SDK's own retry
+    # transport makes a single attempt. The SDK always wraps the transport it is
+    # given and has no setting for this, so it is done on the (pinned) SDK's
+    # internals, checked here so an upgrade that changes them fails loudly
+    retry_transport = getattr(client._client, "_transport", None)
+    if not (
+        isinstance(retry_transport, RetryTransport)
+        and hasattr(retry_transport, "max_attempts")
+        and isinstance(
+            getattr(retry_transport, "_wrapped_transport", None), TimeoutTransport
+        )
+    ):
+        raise RuntimeError(
+            "Unsupported replicate SDK: cannot turn off its retries "
+            "(requirements.txt pins the tested version)"
+        )
+    retry_transport.max_attempts = 1
+    return client
@@ -0,0 +1,436 @@
+from collections import OrderedDict
+from dataclasses import dataclass, replace
+from diffusers import (
+    ControlNetModel,
+    DPMSolverMultistepScheduler,
+    EulerAncestralDiscreteScheduler,
+    LCMScheduler,
+    StableDiffusionControlNetPipeline,
+    UniPCMultistepScheduler,
+)
+from PIL import Image
+import contextlib
+import gc
+import io
+import threading
+import time
+import torch
+
+
+# Default Model Set
+SD_MODEL_ID = "runwayml/stable-diffusion-v1-5"
+CONTROLNET_MODEL_ID = "lllyasviel/control_v11f1e_sd15_tile"
+
+# Number of model sets kept in memory at once (least recently used goes first)
+PIPELINE_CACHE_SIZE = 2
+
+# Denoising Steps, and how often (in steps) a latent preview is decoded
+NUM_INFERENCE_STEPS = 50
+PREVIEW_EVERY = 5
+
+# Dynamic Batching: requests arriving within BATCH_MAX_WAIT seconds of each other
+# (same resolution) share one pipeline call; at most BATCH_MAX_QUEUE may wait
+BATCH_MAX_SIZE = 4
+BATCH_MAX_WAIT = 0.05
+BATCH_MAX_QUEUE = 16
+
+# Longest side of the step Previews (shown in a progress placeholder, not full size)
+PREVIEW_RESOLUTION = 512
+
+# Linear map from SD 1.x latent channels to RGB, far cheaper than a VAE decode
+LATENT_RGB_FACTORS = (
+    (0.3512, 0.2297, 0.3227),
+    (0.3250, 0.4974, 0.2350),
+    (-0.2829, 0.1762, 0.2721),
+    (-0.2120, -0.2616, -0.7177),
+)
+
+DTYPES = {
+    "float32": torch.float32,
+    "float16": torch.float16,
+    "bfloat16": torch.bfloat16,
+}
+
+# Few-step Schedulers, swapped in from the pipeline's own scheduler config
+SCHEDULERS = {
+    "dpm": DPMSolverMultistepScheduler,
+    "unipc": UniPCMultistepScheduler,
+    "euler_a": EulerAncestralDiscreteScheduler,
+    "lcm": LCMScheduler,
+}
+
+# LCM needs distilled weights, so the "lcm" profile fuses this LoRA first
+LCM_LORA_ID = "latent-consistency/lcm-lora-sdv1-5"
+
+
+@dataclass(frozen=True)
+class Profile:
+    attention_slicing: bool = False
+    vae_tiling: bool = False
+    channels_last: bool = False
+    autocast: str = None
+    compile: bool = False
+    threads: int = 0
+    scheduler: str = None
+    lora: str = None
+    steps: int = NUM_INFERENCE_STEPS
+    guidance_scale: float = 7.5
+
+
+# Performance Profiles (DIFFUSERS_PROFILE, "auto" picks one for the device)
+PROFILES = {
+    "default": Profile(),
+    "cpu": Profile(channels_last=True, autocast="bfloat16", scheduler="dpm", steps=20),
+    "cpu-low-memory": Profile(
+        attention_slicing=True, vae_tiling=True, scheduler="dpm", steps=20
+    ),
+    "gpu": Profile(
+        vae_tiling=True, channels_last=True, compile=True, scheduler="unipc", steps=20
+    ),
+    "lcm": Profile(scheduler="lcm", lora=LCM_LORA_ID, steps=4, guidance_scale=1.0),
+}
+
+# Process-wide Pipeline Registry, shared by every Streamlit session
+_pipelines = OrderedDict()
+_pipelines_lock = threading.Lock()
+
+# Batch Schedulers by pipeline, the only callers of their pipeline
+_schedulers = {}
+
+# Inference Locks by pipeline: a pipeline keeps per-call state (scheduler
+# timesteps, step index, guidance scale), so its calls must never overlap
+_inference_locks = {}
+
+
+def select_device(preferred="auto"):
+    if preferred and preferred != "auto":
+        return preferred
+    if torch.cuda.is_available():
+        return "cuda"
+    if torch.backends.mps.is_available():
+        return "mps"
+    return "cpu"
+
+
+def select_dtype(device, precision="auto"):
+    if not precision or precision == "auto":
+        return "float32" if device == "cpu" else "float16"
+
+    # half precision kernels are missing or slow on most CPUs, use bfloat16 instead
+    if device == "cpu" and precision == "float16":
+        return "bfloat16"
+    return precision
+
+
+def get_profile(name="auto", device="cpu", steps=None, threads=None):
+    if not name or name == "auto":
+        name = "cpu" if device == "cpu" else "gpu" if device == "cuda" else "default"
+    if name not in PROFILES:
+        raise ValueError(f"Unknown diffusers profile: {name}")
+
+    # Per-deployment Overrides on top of the named profile
+    overrides = {"steps": steps, "threads": threads}
+    return replace(
+        PROFILES[name], **{key: value for key, value in overrides.items() if value}
+    )
+
+
+def apply_profile(pipe, profile):
+    if profile.threads:
+        torch.set_num_threads(profile.threads)
+    if profile.lora:
+        pipe.load_lora_weights(profile.lora)
+        pipe.fuse_lora()
+    if profile.scheduler:
+        pipe.scheduler = SCHEDULERS[profile.scheduler].from_config(
+            pipe.scheduler.config
+        )
+    if profile.attention_slicing:
+        pipe.enable_attention_slicing()
+    if profile.vae_tiling:
+        pipe.enable_vae_tiling()
+    if profile.channels_last:
+        pipe.unet.to(memory_format=torch.channels_last)
+        pipe.controlnet.to(memory_format=torch.channels_last)
+    if profile.compile:
+        pipe.unet = torch.compile(pipe.unet)
+    return pipe
+
+
+def autocast(pipe, profile):
+    # Mixed precision only helps a float32 pipeline (bfloat16 is the CPU option)
+    if not profile.autocast or pipe.dtype != torch.float32:
+        return contextlib.nullcontext()
+    return torch.autocast(pipe.device.type, dtype=DTYPES[profile.autocast])
+
+
+def get_pipeline(
+    model_id=SD_MODEL_ID,
+    controlnet_id=CONTROLNET_MODEL_ID,
+    dtype="auto",
+    device="auto",
+    profile=None,
+):
+    device = select_device(device)
+    dtype = select_dtype(device, dtype)
+    profile = profile or get_profile(device=device)
+    key = (model_id, controlnet_id, dtype, device, profile)
+
+    # Load under the lock, so concurrent sessions never hold two copies of the weights
+    with _pipelines_lock:
+        if key in _pipelines:
+            _pipelines.move_to_end(key)
+            return _pipelines[key]
+
+        # Load ControlNet Model
+        controlnet = ControlNetModel.from_pretrained(
+            controlnet_id,
+            torch_dtype=DTYPES[dtype],
+        )
+
+        # Setup Stable Diffusion Pipeline
+        pipe = StableDiffusionControlNetPipeline.from_pretrained(
+            model_id,
+            controlnet=controlnet,
+            torch_dtype=DTYPES[dtype],
+        ).to(device)
+        apply_profile(pipe, profile)
+
+        _pipelines[key] = pipe
+        while len(_pipelines) > PIPELINE_CACHE_SIZE:
+            _, evicted = _pipelines.popitem(last=False)
+            close_scheduler(evicted)
+            release_memory(device)
+
+        return pipe
+
+
+def get_scheduler(
+    model_id=SD_MODEL_ID,
+    controlnet_id=CONTROLNET_MODEL_ID,
+    dtype="auto",
+    device="auto",
+    profile=None,
+    max_batch=BATCH_MAX_SIZE,
+    max_wait=BATCH_MAX_WAIT,
+    max_queue=BATCH_MAX_QUEUE,
+):
+    device = select_device(device)
+    profile = profile or get_profile(device=device)
+    pipe = get_pipeline(model_id, controlnet_id, dtype, device, profile)
+
+    with _pipelines_lock:
+        scheduler = _schedulers.get(id(pipe))
+        if scheduler is None:
+            scheduler = BatchScheduler(pipe, profile, max_batch, max_wait, max_queue)
+            _schedulers[id(pipe)] = scheduler
+        return scheduler
+
+
+def inference_lock(pipe):
+    return _inference_locks.setdefault(id(pipe), threading.Lock())
+
+
+def close_scheduler(pipe):
+    _inference_locks.pop(id(pipe), None)
+    scheduler = _schedulers.pop(id(pipe), None)
+    if scheduler:
+        scheduler.close()
+
+
+def clear_pipelines():
+    with _pipelines_lock:
+        devices = {key[3] for key in _pipelines}
+        for pipe in _pipelines.values():
+            close_scheduler(pipe)
+        _pipelines.clear()
+        for device in devices:
+            release_memory(device)
+
+
+def release_memory(device):
+    gc.collect()
+    if device == "cuda":
+        torch.cuda.empty_cache()
+    elif device == "mps":
+        torch.mps.empty_cache()
+
+
+def latents_to_preview(latents, resolution=PREVIEW_RESOLUTION):
+    # Approximate RGB of the first latent in the batch, scaled to the preview
+    # resolution but never past the output size (a latent pixel is 8x8 of it)
+    factors = torch.tensor(LATENT_RGB_FACTORS, device=latents.device)
+    rgb = torch.einsum("chw,cr->hwr", latents[0].float(), factors)
+    pixels = ((rgb + 1) * 127.5).clamp(0, 255).to(torch.uint8).cpu().numpy()
+    image = Image.fromarray(pixels)
+    scale = min(8, resolution / max(image.size))
+    size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+    return image.resize(size, Image.BILINEAR)
+
+
+class GenerationCanceled(Exception):
+    pass
+
+
+class QueueFull(Exception):
+    pass
+
+
+# One request to the engine, with step previews and early cancel
+class Generation:
+
+    def __init__(self, prompt, image, profile, preview_every=PREVIEW_EVERY):
+        self.prompt = prompt
+        self.image = image
+        self.profile = profile
+        self.steps = profile.steps
+        self.preview_every = preview_every
+        self.step = 0
+        self.preview = None
+        self.result = None
+        self.error = None
+        self.canceled = threading.Event()
+        self.finished = threading.Event()
+
+    @property
+    def done(self):
+        return self.finished.is_set()
+
+    @property
+    def batch_key(self):
+        # Only requests of the same resolution fit in one pipeline call
+        return self.image.size
+
+    def cancel(self):
+        self.canceled.set()
+
+    def update(self, step, latents):
+        self.step = step + 1
+        if self.preview_every and (
+            self.step % self.preview_every == 0 or self.step == 1
+        ):
+            self.preview = latents_to_preview(latents)
+
+    def finish(self, result=None, error=None):
+        self.result = result
+        self.error = error
+        self.finished.set()
+
+
+def run_batch(pipe, generations):
+    profile = generations[0].profile
+
+    def on_step_end(pipe, step, timestep, callback_kwargs):
+        # Raising stops the denoising loop right away and skips the final VAE decode
+        if all(generation.canceled.is_set() for generation in generations):
+            raise GenerationCanceled()
+
+        latents = callback_kwargs["latents"]
+        for i, generation in enumerate(generations):
+            if not generation.canceled.is_set():
+                generation.update(step, latents[i : i + 1])
+        return callback_kwargs
+
+    try:
+        with inference_lock(pipe), torch.inference_mode(), autocast(pipe, profile):
+            images = pipe(
+                prompt=[generation.prompt for generation in generations],
+                image=[generation.image for generation in generations],
+                num_inference_steps=profile.steps,
+                guidance_scale=profile.guidance_scale,
+                callback_on_step_end=on_step_end,
+                callback_on_step_end_tensor_inputs=["latents"],
+            ).images
+    except GenerationCanceled:
+        for generation in generations:
+            generation.finish()
+        return
+    except Exception as e:
+        for generation in generations:
+            generation.finish(error=str(e))
+        return
+
+    for generation, image in zip(generations, images):
+        if generation.canceled.is_set():
+            generation.finish()
+            continue
+        buffer = io.BytesIO()
+        image.save(buffer, format="PNG")
+        generation.finish(buffer.getvalue())
+
+
+# Collects concurrent Requests for one pipeline and runs them as batched calls
+class BatchScheduler:
+
+    def __init__(self, pipe, profile, max_batch, max_wait, max_queue):
+        self.pipe = pipe
+        self.profile = profile
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.max_queue = max_queue
+        self._pending = []
+        self._condition = threading.Condition()
+        self._closed = False
+        threading.Thread(target=self._run, daemon=True).start()
+
+    @property
+    def queue_depth(self):
+        with self._condition:
+            return len(self._pending)
+
+    def submit(self, prompt, image, preview_every=PREVIEW_EVERY):
+        generation = Generation(prompt, image, self.profile, preview_every)
+        with self._condition:
+            if self._closed:
+                raise QueueFull("The pipeline was unloaded")
+            if len(self._pending) >= self.max_queue:
+                raise QueueFull(f"{len(self._pending)} requests already waiting")
+            self._pending.append(generation)
+            self._condition.notify()
+        return generation
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            for generation in self._pending:
+                generation.finish(error="The pipeline was unloaded")
+            self._pending.clear()
+            self._condition.notify()
+
+    def _next_batch(self):
+        with self._condition:
+            while not self._pending and not self._closed:
+                self._condition.wait()
+            if self._closed:
+                return None
+
+            # Wait up to max_wait for more requests compatible with the oldest one
+            key = self._pending[0].batch_key
+            deadline = time.monotonic() + self.max_wait
+            while True:
+                batch = [
+                    generation
+                    for generation in self._pending
+                    if generation.batch_key == key
+                ][: self.max_batch]
+                remaining = deadline - time.monotonic()
+                if len(batch) >= self.max_batch or remaining <= 0 or self._closed:
+                    break
+                self._condition.wait(remaining)
+
+            for generation in batch:
+                self._pending.remove(generation)
+
+        # Requests canceled while queued never reach the pipeline
+        for generation in batch:
+            if generation.canceled.is_set():
+                generation.finish()
+        return [generation for generation in batch if not generation.done]
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            if batch:
+                run_batch(self.pipe, batch)
@@ -0,0 +1,258 @@
+from cache import CACHE_DIR, hash_bytes
+from clients import load_config
+from preprocess import OUTPUT_FORMATS
+import contextlib
+import functools
+import io
+import json
+import logging
+import math
+import os
+import sqlite3
+import streamlit as st
+import threading
+import time
+import tracing
+import uuid
+
+
+# Longest side and quality of the thumbnails kept in the index
+THUMBNAIL_SIZE = 256
+THUMBNAIL_QUALITY = 70
+
+# Gallery Grid (thumbnails per page, columns)
+PAGE_SIZE = 12
+COLUMNS = 3
+
+# Prefix of the per-session galleries (apps with one shared login included)
+ANONYMOUS = "anonymous"
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS generations (
+    id INTEGER PRIMARY KEY,
+    user TEXT NOT NULL,
+    app TEXT NOT NULL,
+    backend TEXT,
+    model TEXT,
+    style TEXT,
+    prompt TEXT,
+    caption TEXT,
+    params TEXT,
+    seconds REAL,
+    hash TEXT NOT NULL,
+    format TEXT NOT NULL,
+    bytes INTEGER NOT NULL,
+    width INTEGER,
+    height INTEGER,
+    thumbnail BLOB NOT NULL,
+    created REAL NOT NULL,
+    UNIQUE (user, hash, style)
+);
+CREATE INDEX IF NOT EXISTS generations_by_user ON generations (user, created DESC);
+"""
+
+
+# Generated Images as content-addressed files, indexed in SQLite (with thumbnails)
+class Gallery:
+
+    def __init__(self, path):
+        self.path = path
+        self.db_path = os.path.join(path, "index.sqlite3")
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        with self._connect() as db:
+            db.executescript(SCHEMA)
+
+    def _connect(self):
+        # One short-lived connection per call; WAL lets app processes read while one writes
+        db = sqlite3.connect(self.db_path, timeout=30)
+        db.row_factory = sqlite3.Row
+        db.execute("PRAGMA journal_mode=WAL")
+        return contextlib.closing(db)
+
+    def _file_path(self, digest, image_format):
+        extension = OUTPUT_FORMATS.get(image_format, ("", "", image_format))[2]
+        return os.path.join(self.path, digest[:2], f"{digest}.{extension}")
+
+    def _write_file(self, path, data):
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+    def save(
+        self,
+        user,
+        app,
+        image,
+        backend=None,
+        model=None,
+        style=None,
+        prompt=None,
+        caption=None,
+        params=None,
+        seconds=None,
+    ):
+        from PIL import Image
+
+        # Results shown again (cache hits, reruns) are already in the index
+        digest = hash_bytes(image)
+        with self._connect() as db:
+            if db.execute(
+                "SELECT 1 FROM generations WHERE user = ? AND hash = ? AND style IS ?",
+                (user, digest, style),
+            ).fetchone():
+                return
+
+        with tracing.span("store", "gallery", bytes_in=len(image)) as span:
+            picture = Image.open(io.BytesIO(image))
+            image_format = (picture.format or "png").lower()
+            width, height = picture.size
+
+            # Thumbnail from a reduced decode, as WebP for the grid
+            picture.draft("RGB", (THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+            picture.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+            buffered = io.BytesIO()
+            picture.save(buffered, format="WEBP", quality=THUMBNAIL_QUALITY)
+            span.bytes_out = buffered.tell()
+
+            self._write_file(self._file_path(digest, image_format), image)
+            with self._lock, self._connect() as db, db:
+                db.execute(
+                    "INSERT OR IGNORE INTO generations (user, app, backend, model,"
+                    " style, prompt, caption, params, seconds, hash, format, bytes,"
+                    " width, height, thumbnail, created)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        user,
+                        app,
+                        backend,
+                        model,
+                        style,
+                        prompt,
+                        caption,
+                        json.dumps(params, ensure_ascii=False, default=str),
+                        seconds,
+                        digest,
+                        image_format,
+                        len(image),
+                        width,
+                        height,
+                        buffered.getvalue(),
+                        time.time(),
+                    ),
+                )
+
+    def count(self, user):
+        with self._connect() as db:
+            return db.execute(
+                "SELECT COUNT(*) FROM generations WHERE user = ?", (user,)
+            ).fetchone()[0]
+
+    def page(self, user, page=0, page_size=PAGE_SIZE):
+        # Index rows with thumbnails only; full-size files are read on demand
+        with self._connect() as db:
+            return [
+                dict(row)
+                for row in db.execute(
+                    "SELECT * FROM generations WHERE user = ?"
+                    " ORDER BY created DESC LIMIT ? OFFSET ?",
+                    (user, page_size, page * page_size),
+                )
+            ]
+
+    def get(self, user, entry_id):
+        with self._connect() as db:
+            row = db.execute(
+                "SELECT * FROM generations WHERE user = ? AND id = ?",
+                (user, entry_id),
+            ).fetchone()
+        return dict(row) if row else None
+
+    def read(self, entry):
+        # A File removed from the directory drops its Entry (None: evicted)
+        try:
+            with open(self._file_path(entry["hash"], entry["format"]), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            with self._lock, self._connect() as db, db:
+                db.execute("DELETE FROM generations WHERE id = ?", (entry["id"],))
+            return None
+
+
+def session_user():
+    # Each session only ever sees its own generations (a login may be shared)
+    if "gallery_user" not in st.session_state:
+        st.session_state.gallery_user = f"{ANONYMOUS}-{uuid.uuid4().hex}"
+    return st.session_state.gallery_user
+
+
+@functools.cache
+def get_gallery():
+    return Gallery(load_config().get("GALLERY_DIR", os.path.join(CACHE_DIR, "gallery")))
+
+
+def save(user, app, image, **fields):
+    # Keep a Generation from any backend; a failing store never fails the app
+    try:
+        get_gallery().save(user, app, image, **fields)
+    except Exception as e:
+        logger.warning("Gallery store failed: %s", e)
+
+
+@st.fragment
+def show_gallery(user, page_size=PAGE_SIZE):
+    gallery = get_gallery()
+    total = gallery.count(user)
+    if not total:
+        return
+
+    with st.expander(f"🖼️ Gallery ({total})"):
+        pages = math.ceil(total / page_size)
+        page = (
+            st.number_input("Page", min_value=1, max_value=pages, key="gallery_page")
+            if pages > 1
+            else 1
+        )
+
+        columns = st.columns(COLUMNS)
+        for i, entry in enumerate(gallery.page(user, page - 1, page_size)):
+            with columns[i % COLUMNS]:
+                st.image(
+                    entry["thumbnail"],
+                    caption=entry["caption"] or entry["style"],
+                    use_container_width=True,
+                )
+                if st.button("Open", key=f"gallery_open_{entry['id']}"):
+                    st.session_state.gallery_open = entry["id"]
+
+        # Full-size File of the opened Entry only
+        opened = st.session_state.get("gallery_open")
+        entry = gallery.get(user, opened) if opened else None
+        image = gallery.read(entry) if entry else None
+        if entry and image is None:
+            st.info("This generation was evicted from the gallery.")
+            del st.session_state.gallery_open
+        elif entry:
+            _, mime, extension = OUTPUT_FORMATS.get(
+                entry["format"], ("", "application/octet-stream", entry["format"])
+            )
+            st.image(image, caption=entry["prompt"] or entry["caption"])
+            st.caption(
+                f"{entry['app']} · {entry['backend'] or '-'} · {entry['model'] or '-'}"
+                f" · {entry['width']}x{entry['height']}"
+                + (f" · {entry['seconds']:.1f}s" if entry["seconds"] else "")
+                + f" · {time.strftime('%Y-%m-%d %H:%M', time.localtime(entry['created']))}"
+            )
+            st.download_button(
+                "Download",
+                data=image,
+                file_name=f"cartoon-{entry['id']}.{extension}",
+                mime=mime,
+                key="gallery_download",
+            )
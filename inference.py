@@ -0,0 +1,153 @@
+from cache import CACHE_DIR
+from multiprocessing import resource_tracker, shared_memory
+import json
+import os
+import socket
+import threading
+
+
+# Unix Socket of the shared Inference Worker (inference_worker.py)
+SOCKET_PATH = os.path.join(CACHE_DIR, "diffusers.sock")
+
+# Seconds to wait for the worker to accept a request
+SUBMIT_TIMEOUT = 10
+
+
+class WorkerUnavailable(Exception):
+    pass
+
+
+class QueueFull(Exception):
+    pass
+
+
+# Messages are JSON lines; pixels and images travel through shared memory
+def send_message(stream, message):
+    stream.write(json.dumps(message).encode("utf-8") + b"\n")
+    stream.flush()
+
+
+def read_message(stream):
+    line = stream.readline()
+    return json.loads(line) if line else None
+
+
+def create_block(data):
+    block = shared_memory.SharedMemory(create=True, size=max(1, len(data)))
+    block.buf[: len(data)] = data
+    return block
+
+
+def read_block(name, size):
+    # Only the creator unlinks a block, so attaching must not register it with
+    # this process' resource tracker (track=False from Python 3.13)
+    block = shared_memory.SharedMemory(name=name)
+    resource_tracker.unregister(block._name, "shared_memory")
+    try:
+        return bytes(block.buf[:size])
+    finally:
+        block.close()
+
+
+# Generation running in the worker, with the interface of diffusion.Generation
+class RemoteGeneration:
+
+    def __init__(self, connection, stream, steps, model):
+        self.steps = steps
+        self.model = model
+        self.step = 0
+        self.preview = None
+        self.result = None
+        self.error = None
+        self.finished = threading.Event()
+        self._connection = connection
+        self._stream = stream
+        self._lock = threading.Lock()
+        threading.Thread(target=self._listen, daemon=True).start()
+
+    @property
+    def done(self):
+        return self.finished.is_set()
+
+    def cancel(self):
+        with self._lock:
+            if self.done:
+                return
+            try:
+                send_message(self._stream, {"op": "cancel"})
+            except OSError:
+                pass
+
+    def _listen(self):
+        from PIL import Image
+
+        try:
+            while message := read_message(self._stream):
+                if message["event"] == "step":
+                    self.step = message["step"]
+                    if preview := message.get("preview"):
+                        width, height = preview["size"]
+                        self.preview = Image.frombytes(
+                            "RGB",
+                            (width, height),
+                            read_block(preview["name"], width * height * 3),
+                        )
+                elif message["event"] == "result":
+                    self.result = read_block(message["name"], message["bytes"])
+                    break
+                elif message["event"] == "done":
+                    self.error = message.get("error")
+                    break
+            else:
+                self.error = "The inference worker closed the connection"
+        except (OSError, ValueError) as e:
+            self.error = f"Lost the inference worker: {e}"
+        finally:
+            # Closing tells the worker the result was read, so it frees the blocks
+            with self._lock:
+                self.finished.set()
+                self._stream.close()
+                self._connection.close()
+
+
+def submit(prompt, image, preview_every, socket_path=SOCKET_PATH):
+    # Queue a generation in the worker; the photo's pixels go by shared memory
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.settimeout(SUBMIT_TIMEOUT)
+    try:
+        connection.connect(socket_path)
+    except OSError as e:
+        connection.close()
+        raise WorkerUnavailable(f"No inference worker on {socket_path}: {e}")
+
+    stream = connection.makefile("rwb")
+    image = image.convert("RGB")
+    block = create_block(image.tobytes())
+    try:
+        send_message(
+            stream,
+            {
+                "op": "submit",
+                "prompt": prompt,
+                "image": {"name": block.name, "size": image.size},
+                "preview_every": preview_every,
+            },
+        )
+        reply = read_message(stream)
+    except OSError as e:
+        stream.close()
+        connection.close()
+        raise WorkerUnavailable(f"Inference worker failed: {e}")
+    finally:
+        block.close()
+        block.unlink()
+
+    if reply is None or reply["event"] != "queued":
+        stream.close()
+        connection.close()
+        if reply and reply["event"] == "busy":
+            raise QueueFull(reply["error"])
+        raise WorkerUnavailable((reply or {}).get("error", "No reply"))
+
+    connection.settimeout(None)
+    return RemoteGeneration(connection, stream, reply["steps"], reply["model"])
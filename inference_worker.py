@@ -0,0 +1,181 @@
+from clients import load_config
+from inference import SOCKET_PATH, create_block, read_block, read_message, send_message
+from PIL import Image
+from preprocess import fit_control_image
+from socketserver import StreamRequestHandler, ThreadingUnixStreamServer
+import argparse
+import diffusion
+import os
+import signal
+import socket
+import sys
+import threading
+
+
+# How often a request's progress (step, preview) is pushed to its client
+UPDATE_INTERVAL = 0.2
+
+# Seconds a finished result stays in shared memory for its client to read
+RESULT_TIMEOUT = 30
+
+
+# One Pipeline and Batch Scheduler shared by every app replica on the node
+class InferenceServer(ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, scheduler, model_id):
+        super().__init__(path, InferenceHandler)
+        self.scheduler = scheduler
+        self.model_id = model_id
+
+
+class InferenceHandler(StreamRequestHandler):
+
+    def handle(self):
+        request = read_message(self.rfile)
+        if not request or request.get("op") != "submit":
+            return
+
+        # Copy the photo out of the client's block, which it frees on our reply
+        width, height = request["image"]["size"]
+        image = Image.frombytes(
+            "RGB",
+            (width, height),
+            read_block(request["image"]["name"], width * height * 3),
+        )
+        # Clients that sent a photo of any other size still batch by bucket
+        image = fit_control_image(image)
+        try:
+            generation = self.server.scheduler.submit(
+                request["prompt"], image, request["preview_every"]
+            )
+        except diffusion.QueueFull as e:
+            send_message(self.wfile, {"event": "busy", "error": str(e)})
+            return
+        send_message(
+            self.wfile,
+            {
+                "event": "queued",
+                "steps": generation.steps,
+                "model": self.server.model_id,
+            },
+        )
+
+        # Cancel on request, or as soon as the client goes away
+        closed = threading.Event()
+
+        def listen():
+            while message := read_message(self.rfile):
+                if message.get("op") == "cancel":
+                    generation.cancel()
+            generation.cancel()
+            closed.set()
+
+        threading.Thread(target=listen, daemon=True).start()
+
+        blocks = []
+        try:
+            self.push_progress(generation, blocks)
+            if generation.result:
+                blocks.append(create_block(generation.result))
+                send_message(
+                    self.wfile,
+                    {
+                        "event": "result",
+                        "name": blocks[-1].name,
+                        "bytes": len(generation.result),
+                    },
+                )
+            else:
+                send_message(self.wfile, {"event": "done", "error": generation.error})
+            closed.wait(RESULT_TIMEOUT)
+        except OSError:
+            generation.cancel()
+        finally:
+            for block in blocks:
+                block.close()
+                block.unlink()
+
+    def push_progress(self, generation, blocks):
+        # Previews overwrite one block in place; the client copies each as announced
+        step = 0
+        preview = None
+        while not generation.finished.wait(UPDATE_INTERVAL):
+            if generation.step == step:
+                continue
+            step = generation.step
+            message = {"event": "step", "step": step}
+            if generation.preview is not None and generation.preview is not preview:
+                preview = generation.preview
+                pixels = preview.convert("RGB").tobytes()
+                if blocks and blocks[0].size >= len(pixels):
+                    blocks[0].buf[: len(pixels)] = pixels
+                else:
+                    for block in blocks:
+                        block.close()
+                        block.unlink()
+                    blocks[:] = [create_block(pixels)]
+                message["preview"] = {"name": blocks[0].name, "size": preview.size}
+            send_message(self.wfile, message)
+
+
+def bind(path):
+    # Replace a stale socket file, but never a worker that is still serving
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except OSError:
+            os.unlink(path)
+        else:
+            raise SystemExit(f"An inference worker is already serving {path}")
+        finally:
+            probe.close()
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+
+def main(argv=None):
+    config = load_config()
+    parser = argparse.ArgumentParser(
+        description="Serve the diffusers pipeline to every app replica on this node"
+    )
+    parser.add_argument("--socket", default=config.get("DIFFUSERS_SOCKET", SOCKET_PATH))
+    parser.add_argument("--device", default=config.get("DIFFUSERS_DEVICE", "auto"))
+    parser.add_argument("--dtype", default=config.get("DIFFUSERS_PRECISION", "auto"))
+    parser.add_argument(
+        "-p", "--profile", default=config.get("DIFFUSERS_PROFILE", "auto")
+    )
+    args = parser.parse_args(argv)
+
+    bind(args.socket)
+
+    # Load the Pipeline once, before accepting requests
+    device = diffusion.select_device(args.device)
+    profile = diffusion.get_profile(
+        args.profile,
+        device,
+        int(config.get("DIFFUSERS_STEPS", 0)),
+        int(config.get("DIFFUSERS_THREADS", 0)),
+    )
+    scheduler = diffusion.get_scheduler(
+        dtype=args.dtype,
+        device=device,
+        profile=profile,
+        max_batch=int(config.get("DIFFUSERS_BATCH_SIZE", diffusion.BATCH_MAX_SIZE)),
+        max_wait=float(config.get("DIFFUSERS_BATCH_WAIT_MS", 50)) / 1000,
+        max_queue=int(config.get("DIFFUSERS_QUEUE_DEPTH", diffusion.BATCH_MAX_QUEUE)),
+    )
+
+    server = InferenceServer(args.socket, scheduler, diffusion.SD_MODEL_ID)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    os.chmod(args.socket, 0o660)
+    print(f"inference worker ({device}, {profile.steps} steps) on {args.socket}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.unlink(args.socket)
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,94 @@
+from clients import request_timeout
+import admission
+import resilience
+import threading
+import time
+
+
+# Replicate keeps prediction outputs for about an hour
+JOB_TTL = 60 * 60
+
+# Prediction Statuses
+PENDING_STATUSES = ("starting", "processing")
+FAILED_STATUSES = ("failed", "canceled")
+
+# In-flight predictions by request key, shared by every session of the process
+_jobs = {}
+_jobs_lock = threading.Lock()
+
+
+def model_reference(model):
+    # "owner/name:version" runs a pinned version, "owner/name" the latest one
+    if ":" in model:
+        return {"version": model.split(":", 1)[1]}
+    return {"model": model}
+
+
+def start_prediction(client, model, model_input, request_key):
+    now = time.time()
+    with _jobs_lock:
+        for key in [key for key, job in _jobs.items() if now - job["at"] > JOB_TTL]:
+            del _jobs[key]
+        job = _jobs.setdefault(
+            request_key, {"id": None, "at": now, "lock": threading.Lock()}
+        )
+
+    # Reattach to the prediction already running for the same request (the
+    # admission slot covers the creation only, see admission.LIMITS)
+    with job["lock"]:
+        if job["id"] is None:
+            with admission.admit("replicate"):
+                prediction = create_prediction(client, model, model_input)
+            job["id"] = prediction.id
+        return job["id"]
+
+
+def create_prediction(client, model, model_input):
+    # Creating is not idempotent, so only rejected requests are retried
+    def create(timeout):
+        with request_timeout(timeout):
+            return client.predictions.create(
+                **model_reference(model), input=model_input
+            )
+
+    return resilience.call("prediction", "replicate", create)
+
+
+def get_prediction(client, prediction_id):
+    def poll(timeout):
+        with request_timeout(timeout):
+            return client.predictions.get(prediction_id)
+
+    return resilience.call("poll", "replicate", poll)
+
+
+def run_prediction(client, model, model_input):
+    # Create and poll until done, canceling a prediction past its deadline
+    prediction = create_prediction(client, model, model_input)
+    deadline = time.monotonic() + resilience.get_policy("prediction").timeout
+    while prediction.status in PENDING_STATUSES:
+        if time.monotonic() > deadline:
+            client.predictions.cancel(prediction.id)
+            raise TimeoutError(f"Prediction {prediction.id} did not finish in time")
+        time.sleep(client.poll_interval)
+        prediction = get_prediction(client, prediction.id)
+    if prediction.status in FAILED_STATUSES:
+        raise RuntimeError(prediction.error or f"Prediction {prediction.status}")
+    return prediction
+
+
+def cancel_prediction(client, prediction_id, request_key):
+    client.predictions.cancel(prediction_id)
+    finish_prediction(request_key)
+
+
+def finish_prediction(request_key):
+    with _jobs_lock:
+        _jobs.pop(request_key, None)
+
+
+def prediction_output_url(prediction):
+    output = prediction.output
+    if isinstance(output, list):
+        return str(output[0]) if output else None
+    return str(output) if output else None
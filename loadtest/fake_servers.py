@@ -0,0 +1,303 @@
+from benchmarks.fixtures import make_photo
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import base64
+import json
+import random
+import re
+import resource
+import threading
+import time
+import uuid
+
+
+# Simulated Upstream Latency (seconds) per route
+LATENCY = {
+    "upload": 0.3,
+    "worker": 3.0,
+    "replicate": 5.0,
+    "chat": 2.0,
+    "images": 8.0,
+    "cdn": 0.2,
+}
+JITTER = 0.2
+
+RESULT_SIZE = (1024, 1024)
+
+PREDICTION_PATH = re.compile(r"^/v1/predictions/([^/]+)(/cancel)?$")
+VERSION_PATH = re.compile(r"^/v1/models/[^/]+/[^/]+/versions/([^/]+)$")
+MODEL_PREDICTION_PATH = re.compile(r"^/v1/models/([^/]+/[^/]+)/predictions$")
+
+
+def parse_routes(values, defaults=None):
+    # "route=value" pairs from the command line, e.g. "images=2.5"
+    routes = dict(defaults or {})
+    for value in values:
+        route, _, number = value.partition("=")
+        if route not in LATENCY:
+            raise ValueError(f"Unknown route: {route}")
+        routes[route] = float(number)
+    return routes
+
+
+# Local stand-in for Cloudflare Images, the cartoonize worker, Replicate and OpenAI
+class FakeUpstreams(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency=None, error_rates=None, jitter=JITTER):
+        super().__init__(address, FakeHandler)
+        self.latency = {**LATENCY, **(latency or {})}
+        self.error_rates = error_rates or {}
+        self.jitter = jitter
+        self.result_image = make_photo(RESULT_SIZE, "PNG")
+        self.predictions = {}
+        self.predictions_lock = threading.Lock()
+        self.requests = dict.fromkeys(LATENCY, 0)
+        self.errors = dict.fromkeys(LATENCY, 0)
+        self.stats_lock = threading.Lock()
+
+    def delay(self, route):
+        latency = self.latency[route]
+        return random.uniform(latency * (1 - self.jitter), latency * (1 + self.jitter))
+
+    def should_fail(self, route):
+        failed = random.random() < self.error_rates.get(route, 0)
+        with self.stats_lock:
+            self.requests[route] += 1
+            self.errors[route] += failed
+        return failed
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def base_url(self):
+        return f"http://{self.headers.get('Host')}"
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+    def send_json(self, payload, status=200):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def simulate(self, route):
+        # Sleep like the real upstream, then fail at the configured rate
+        time.sleep(self.server.delay(route))
+        if self.server.should_fail(route):
+            self.send_json({"error": {"message": f"injected {route} failure"}}, 500)
+            return False
+        return True
+
+    def do_GET(self):
+        if self.path.startswith("/cdn/"):
+            if self.simulate("cdn"):
+                data = self.server.result_image
+                self.send_response(200)
+                self.send_header("Content-Type", "image/png")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+        elif match := PREDICTION_PATH.match(self.path):
+            self.send_prediction(match.group(1))
+        elif self.path == "/stats":
+            with self.server.stats_lock:
+                self.send_json(
+                    {
+                        "requests": self.server.requests,
+                        "errors": self.server.errors,
+                        "peak_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                        / 1024,
+                    }
+                )
+        elif match := VERSION_PATH.match(self.path):
+            self.send_json(
+                {
+                    "id": match.group(1),
+                    "created_at": "2024-01-01T00:00:00Z",
+                    "cog_version": "0.9.0",
+                    "openapi_schema": {},
+                }
+            )
+        else:
+            self.send_json({"error": "not found"}, 404)
+
+    def do_POST(self):
+        body = self.read_body()
+        if self.path.endswith("/images/v1"):
+            self.upload()
+        elif self.path == "/worker":
+            self.worker()
+        elif self.path == "/v1/predictions":
+            self.create_prediction(json.loads(body), None)
+        elif match := MODEL_PREDICTION_PATH.match(self.path):
+            self.create_prediction(json.loads(body), match.group(1))
+        elif (match := PREDICTION_PATH.match(self.path)) and match.group(2):
+            self.cancel_prediction(match.group(1))
+        elif self.path == "/v1/chat/completions":
+            self.chat(json.loads(body))
+        elif self.path == "/v1/images/generations":
+            self.images(json.loads(body))
+        else:
+            self.send_json({"error": "not found"}, 404)
+
+    def result_url(self):
+        return f"{self.base_url}/cdn/{uuid.uuid4().hex}.png"
+
+    def upload(self):
+        if self.simulate("upload"):
+            self.send_json(
+                {
+                    "success": True,
+                    "result": {
+                        "id": uuid.uuid4().hex,
+                        "variants": [f"{self.base_url}/cdn/{uuid.uuid4().hex}.jpg"],
+                    },
+                }
+            )
+
+    def worker(self):
+        if self.simulate("worker"):
+            self.send_json(
+                {"success": True, "result": {"variants": [self.result_url()]}}
+            )
+
+    def create_prediction(self, payload, model):
+        if self.server.should_fail("replicate"):
+            self.send_json({"detail": "injected replicate failure"}, 500)
+            return
+
+        prediction_id = uuid.uuid4().hex
+        with self.server.predictions_lock:
+            self.server.predictions[prediction_id] = {
+                "model": model or "fake/model",
+                "version": payload.get("version") or "latest",
+                "input": payload.get("input"),
+                "created": time.time(),
+                "done": time.time() + self.server.delay("replicate"),
+                "output": [self.result_url()],
+                "status": None,
+            }
+
+        # "Prefer: wait" blocks until the prediction finishes
+        if self.headers.get("Prefer", "").startswith("wait"):
+            with self.server.predictions_lock:
+                done = self.server.predictions[prediction_id]["done"]
+            time.sleep(max(0, done - time.time()))
+        self.send_prediction(prediction_id, 201)
+
+    def cancel_prediction(self, prediction_id):
+        with self.server.predictions_lock:
+            prediction = self.server.predictions.get(prediction_id)
+            if prediction:
+                prediction["status"] = "canceled"
+        self.send_prediction(prediction_id)
+
+    def send_prediction(self, prediction_id, status=200):
+        with self.server.predictions_lock:
+            prediction = self.server.predictions.get(prediction_id)
+        if prediction is None:
+            self.send_json({"detail": "not found"}, 404)
+            return
+
+        now = time.time()
+        state = prediction["status"] or (
+            "succeeded" if now >= prediction["done"] else "processing"
+        )
+        self.send_json(
+            {
+                "id": prediction_id,
+                "model": prediction["model"],
+                "version": prediction["version"],
+                "status": state,
+                "input": prediction["input"],
+                "output": prediction["output"] if state == "succeeded" else None,
+                "logs": "",
+                "error": None,
+                "metrics": {"predict_time": prediction["done"] - prediction["created"]},
+                "created_at": None,
+                "started_at": None,
+                "completed_at": None,
+                "urls": {
+                    "get": f"{self.base_url}/v1/predictions/{prediction_id}",
+                    "cancel": f"{self.base_url}/v1/predictions/{prediction_id}/cancel",
+                },
+            },
+            status,
+        )
+
+    def chat(self, payload):
+        if self.simulate("chat"):
+            self.send_json(
+                {
+                    "id": f"chatcmpl-{uuid.uuid4().hex}",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": payload.get("model"),
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {
+                                "role": "assistant",
+                                "content": "A cheerful cartoon portrait with bold outlines and bright colors.",
+                            },
+                            "finish_reason": "stop",
+                        }
+                    ],
+                    "usage": {
+                        "prompt_tokens": 100,
+                        "completion_tokens": 20,
+                        "total_tokens": 120,
+                    },
+                }
+            )
+
+    def images(self, payload):
+        if self.simulate("images"):
+            # b64_json carries the image itself, url points at the fake CDN
+            if payload.get("response_format") == "b64_json":
+                image = {
+                    "b64_json": base64.b64encode(self.server.result_image).decode()
+                }
+            else:
+                image = {"url": self.result_url()}
+            self.send_json(
+                {
+                    "created": int(time.time()),
+                    "data": [{**image, "revised_prompt": payload.get("prompt")}],
+                }
+            )
+
+
+def serve(port, latency=None, error_rates=None, ready=None):
+    server = FakeUpstreams(("127.0.0.1", port), latency, error_rates)
+    if ready is not None:
+        ready.put(server.server_port)
+    server.serve_forever()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Serve local stand-ins for Cloudflare, Replicate and OpenAI"
+    )
+    parser.add_argument("-p", "--port", type=int, default=8787)
+    parser.add_argument("--latency", action="append", default=[], help="route=seconds")
+    parser.add_argument(
+        "--error-rate", action="append", default=[], help="route=probability"
+    )
+    args = parser.parse_args(argv)
+
+    print(f"fake upstreams on http://127.0.0.1:{args.port}")
+    serve(args.port, parse_routes(args.latency), parse_routes(args.error_rate, {}))
+
+
+if __name__ == "__main__":
+    main()
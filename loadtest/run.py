@@ -0,0 +1,379 @@
+from benchmarks.fixtures import make_photo
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from loadtest.fake_servers import LATENCY, parse_routes, serve
+from PIL import Image
+from statistics import mean, quantiles
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+import urllib.request
+import uuid
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Scenarios: app scripts driven through AppTest, photo pipelines called directly
+# (AppTest cannot fill a file uploader)
+SCENARIOS = ("prompt", "dalle", "replicate", "openai", "worker")
+
+PHOTO_SIZE = (1280, 960)
+APP_TIMEOUT = 300
+
+# Configuration of the apps under test, pointing every upstream at the fakes
+ENV_TEMPLATE = """\
+CUSTOM_LOGIN_ID=loadtest
+CUSTOM_LOGIN_PW=loadtest
+CUSTOM_LANGUAGE=English
+CLOUDFLARE_ACCOUNT_ID=loadtest
+CLOUDFLARE_API_URL={base_url}/client/v4/accounts
+CLOUDFLARE_API_TOKEN_IMAGES=fake-cloudflare-token
+CLOUDFLARE_WORKER_URL={base_url}/worker
+OPENAI_API_KEY=fake-openai-key
+OPENAI_BASE_URL={base_url}/v1
+OPENAI_MODEL_TTI=dall-e-3
+OPENAI_MODEL_DRAW=dall-e-3
+REPLICATE_API_TOKEN=fake-replicate-token
+REPLICATE_API_URL={base_url}
+REPLICATE_MODEL_ITI=stability-ai/sdxl:loadtest
+REPLICATE_IMAGE_INPUT={image_input}
+TRACE_FILE={trace_file}
+"""
+
+
+# Uploaded Photo with the interface of Streamlit's UploadedFile (name, getvalue)
+class UploadedPhoto(io.BytesIO):
+    def __init__(self, data, name):
+        super().__init__(data)
+        self.name = name
+
+
+def unique_photo(base_photo):
+    # Touch one pixel, so every request misses the upload and result caches
+    image = Image.open(io.BytesIO(base_photo))
+    image.putpixel(
+        (random.randrange(image.width), random.randrange(image.height)),
+        (random.randrange(256), random.randrange(256), random.randrange(256)),
+    )
+    buffered = io.BytesIO()
+    image.save(buffered, format="JPEG", quality=92)
+    return UploadedPhoto(buffered.getvalue(), f"{uuid.uuid4().hex}.jpg")
+
+
+def make_scenarios(base_photo):
+    # Imported here, once the working directory holds the fake .env and cache
+    from clients import get_openai_client, get_replicate_client, load_config
+    from preprocess import prepare_upload
+    from streamlit.testing.v1 import AppTest
+    import cartoonize
+
+    config = load_config()
+    style = cartoonize.CARTOON_STYLES[0]
+
+    def run_app(script, input_source=None):
+        at = AppTest.from_file(
+            os.path.join(REPO_DIR, script), default_timeout=APP_TIMEOUT
+        )
+        at.session_state.logged_in = True
+        at.run()
+        if input_source:
+            at.sidebar.selectbox[0].select(input_source).run()
+        at.text_input[0].input(f"A cartoon cat on a skateboard {uuid.uuid4().hex}")
+        at.run()
+
+        # Time only what the user waits for after clicking
+        button = next(button for button in at.button if "Cartoonize" in button.label)
+        started = time.perf_counter()
+        button.click().run()
+        elapsed = time.perf_counter() - started
+
+        failures = [e.value for e in at.exception] + [e.value for e in at.error]
+        if failures:
+            raise RuntimeError(failures[0])
+        return elapsed
+
+    def prompt():
+        return run_app("app.py", "텍스트 | prompt")
+
+    def dalle():
+        return run_app("app_dalle.py")
+
+    def replicate():
+        started = time.perf_counter()
+        upload_image = prepare_upload(unique_photo(base_photo), aspect_ratio="1:1")
+        image_url = cartoonize.get_image_input(
+            upload_image,
+            config["CLOUDFLARE_ACCOUNT_ID"],
+            config["CLOUDFLARE_API_URL"],
+            config["CLOUDFLARE_API_TOKEN_IMAGES"],
+            config["REPLICATE_IMAGE_INPUT"],
+        )
+        cartoonize.transform_by_replicate(
+            get_replicate_client(config["REPLICATE_API_TOKEN"]),
+            config["REPLICATE_MODEL_ITI"],
+            image_url,
+            cartoonize.get_replicate_input(style, "", 0.75, 10, "1:1"),
+            uuid.uuid4().hex,
+        )
+        return time.perf_counter() - started
+
+    def openai():
+        started = time.perf_counter()
+        img_base64 = cartoonize.encode_photo(Image.open(unique_photo(base_photo)))
+        cartoonize.transform_by_openai(
+            get_openai_client(config["OPENAI_API_KEY"]),
+            config["OPENAI_MODEL_TTI"],
+            img_base64,
+            style,
+            "1024x1024",
+            uuid.uuid4().hex,
+        )
+        return time.perf_counter() - started
+
+    def worker():
+        started = time.perf_counter()
+        upload_image = prepare_upload(unique_photo(base_photo))
+        cartoonize.transform_by_worker(
+            config["CLOUDFLARE_WORKER_URL"], "Disney", upload_image
+        )
+        return time.perf_counter() - started
+
+    return {
+        "prompt": prompt,
+        "dalle": dalle,
+        "replicate": replicate,
+        "openai": openai,
+        "worker": worker,
+    }
+
+
+def percentiles(values):
+    if len(values) < 2:
+        return dict.fromkeys(("p50", "p95", "p99"), values[0] if values else None)
+    cuts = quantiles(values, n=100, method="inclusive")
+    return {"p50": cuts[49], "p95": cuts[94], "p99": cuts[98]}
+
+
+def format_seconds(value):
+    return "-" if value is None else f"{value:.2f}"
+
+
+def stage_breakdown(trace_file):
+    # Per-stage latency from the span log the apps wrote during the run
+    stages = defaultdict(list)
+    if os.path.exists(trace_file):
+        with open(trace_file, encoding="utf-8") as f:
+            for line in f:
+                span = json.loads(line)
+                stages[f"{span['stage']}/{span['backend']}"].append(span["seconds"])
+    return {
+        stage: {"count": len(values), **percentiles(values)}
+        for stage, values in sorted(stages.items())
+    }
+
+
+def report(results, elapsed, memory, stages, upstreams):
+    print(f"{'scenario':12} {'ok':>6} {'errors':>6} {'p50':>7} {'p95':>7} {'p99':>7}")
+    summary = {}
+    for scenario in [*sorted({r["scenario"] for r in results}), "all"]:
+        scenario_results = [r for r in results if scenario in ("all", r["scenario"])]
+        latencies = [r["seconds"] for r in scenario_results if r["ok"]]
+        errors = len(scenario_results) - len(latencies)
+        summary[scenario] = {
+            "ok": len(latencies),
+            "errors": errors,
+            "mean": mean(latencies) if latencies else None,
+            **percentiles(latencies),
+        }
+        print(
+            f"{scenario:12} {len(latencies):6} {errors:6} "
+            + " ".join(
+                f"{format_seconds(summary[scenario][p]):>7}"
+                for p in ("p50", "p95", "p99")
+            )
+        )
+
+    throughput = summary["all"]["ok"] / elapsed if elapsed else 0
+    print("---")
+    print(f"elapsed: {elapsed:.1f}s, throughput: {throughput * 60:.1f} requests/min")
+    session_peak = memory["session_peak_mb"]
+    print(
+        f"peak RSS per session process: {session_peak['min']:.0f}–"
+        f"{session_peak['max']:.0f} MB (mean {session_peak['mean']:.0f} MB), "
+        f"fake upstreams {memory['upstreams_peak_mb']:.0f} MB"
+    )
+
+    if stages:
+        print("---")
+        print(f"{'stage':28} {'count':>6} {'p50':>7} {'p95':>7} {'p99':>7}")
+        for stage, values in stages.items():
+            print(
+                f"{stage:28} {values['count']:6} "
+                + " ".join(
+                    f"{format_seconds(values[p]):>7}" for p in ("p50", "p95", "p99")
+                )
+            )
+
+    if upstreams:
+        print("---")
+        print(
+            "upstream requests: "
+            + ", ".join(
+                f"{route} {count} ({upstreams['errors'][route]} failed)"
+                for route, count in upstreams["requests"].items()
+                if count
+            )
+        )
+
+    return {
+        "elapsed": elapsed,
+        "throughput": throughput,
+        "scenarios": summary,
+        "memory": memory,
+        "stages": stages,
+        "upstreams": upstreams,
+    }
+
+
+def run_session(index, scenarios, requests, think, directory, barrier):
+    # One Streamlit-like process per session (AppTest keeps a global runtime)
+    sys.path.insert(0, REPO_DIR)
+    os.chdir(directory)
+    scenario_funcs = make_scenarios(make_photo(PHOTO_SIZE, "JPEG"))
+    barrier.wait()
+
+    results = []
+    for i in range(requests):
+        scenario = scenarios[(index + i) % len(scenarios)]
+        started = time.time()
+        try:
+            seconds, ok, error = scenario_funcs[scenario](), True, None
+        except Exception as e:
+            seconds, ok, error = None, False, str(e)
+            print(f"❌ session {index} {scenario}: {e}")
+        results.append(
+            {
+                "scenario": scenario,
+                "seconds": seconds,
+                "ok": ok,
+                "error": error,
+                "started": started,
+                "finished": time.time(),
+            }
+        )
+        if think:
+            time.sleep(think)
+
+    peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return results, peak_mb
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Load test the cartoonize apps against local fake upstreams"
+    )
+    parser.add_argument("-n", "--sessions", type=int, default=8)
+    parser.add_argument("-r", "--requests", type=int, default=3, help="per session")
+    parser.add_argument(
+        "-s", "--scenario", action="append", choices=SCENARIOS, default=[]
+    )
+    parser.add_argument("--think", type=float, default=0, help="seconds between")
+    parser.add_argument("--latency", action="append", default=[], help="route=seconds")
+    parser.add_argument(
+        "--latency-scale", type=float, default=1, help="multiply every latency"
+    )
+    parser.add_argument(
+        "--error-rate", action="append", default=[], help="route=probability"
+    )
+    parser.add_argument(
+        "--image-input",
+        choices=("auto", "data", "url"),
+        default="auto",
+        help="how the replicate scenario passes the photo",
+    )
+    parser.add_argument("--json", help="also write the report as JSON")
+    args = parser.parse_args(argv)
+    scenarios = args.scenario or list(SCENARIOS)
+
+    latency = {
+        route: seconds * args.latency_scale
+        for route, seconds in parse_routes(args.latency, LATENCY).items()
+    }
+    error_rates = parse_routes(args.error_rate, {})
+
+    # Fake Upstreams in their own process
+    context = multiprocessing.get_context("spawn")
+    ready = context.Queue()
+    upstreams = context.Process(
+        target=serve, args=(0, latency, error_rates, ready), daemon=True
+    )
+    upstreams.start()
+    base_url = f"http://127.0.0.1:{ready.get(timeout=30)}"
+
+    with tempfile.TemporaryDirectory() as directory, context.Manager() as manager:
+        # Run the apps from a scratch directory (own .env, cache and span log)
+        trace_file = os.path.join(directory, "traces.jsonl")
+        with open(os.path.join(directory, ".env"), "w", encoding="utf-8") as f:
+            f.write(
+                ENV_TEMPLATE.format(
+                    base_url=base_url,
+                    trace_file=trace_file,
+                    image_input=args.image_input,
+                )
+            )
+
+        print(
+            f"{args.sessions} sessions × {args.requests} requests "
+            f"({', '.join(scenarios)}) against {base_url}"
+        )
+        barrier = manager.Barrier(args.sessions)
+        with ProcessPoolExecutor(
+            max_workers=args.sessions, mp_context=context
+        ) as executor:
+            sessions = list(
+                executor.map(
+                    run_session,
+                    range(args.sessions),
+                    [scenarios] * args.sessions,
+                    [args.requests] * args.sessions,
+                    [args.think] * args.sessions,
+                    [directory] * args.sessions,
+                    [barrier] * args.sessions,
+                )
+            )
+
+        stages = stage_breakdown(trace_file)
+        with urllib.request.urlopen(f"{base_url}/stats") as response:
+            upstream_stats = json.load(response)
+
+    upstreams.terminate()
+    upstreams.join()
+
+    results = [result for session_results, _ in sessions for result in session_results]
+    elapsed = max(r["finished"] for r in results) - min(r["started"] for r in results)
+    session_peaks = [peak_mb for _, peak_mb in sessions]
+    memory = {
+        "session_peak_mb": {
+            "min": min(session_peaks),
+            "mean": mean(session_peaks),
+            "max": max(session_peaks),
+        },
+        "upstreams_peak_mb": upstream_stats.pop("peak_mb"),
+    }
+
+    summary = report(results, elapsed, memory, stages, upstream_stats)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2)
+    return 1 if summary["scenarios"]["all"]["errors"] else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,214 @@
+from clients import load_config
+from collections import defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+import contextvars
+import functools
+import math
+import random
+import sys
+import threading
+import time
+import tracing
+
+
+# Jittered Exponential Backoff (seconds) between attempts
+BACKOFF = 0.5
+MAX_BACKOFF = 8
+
+# HTTP Statuses worth another attempt; steps that are not idempotent only
+# retry rejections, where the upstream did no work
+RETRY_STATUSES = (408, 429, 500, 502, 503, 504)
+REJECTED_STATUSES = (429,)
+
+# Hedging: a second attempt starts once the first is slower than the p95 of
+# the last HEDGE_WINDOW attempts (after HEDGE_MIN_SAMPLES of them)
+HEDGE_QUANTILE = 0.95
+HEDGE_WINDOW = 50
+HEDGE_MIN_SAMPLES = 10
+HEDGE_WORKERS = 16
+
+
+@dataclass(frozen=True)
+class Policy:
+    timeout: float = 30  # seconds per attempt
+    attempts: int = 1
+    idempotent: bool = True
+    hedge: bool = False
+
+
+# Default Policies per Step, each overridable as RESILIENCE_<STEP>_<FIELD>
+POLICIES = {
+    "upload": Policy(timeout=30, attempts=3, hedge=True),
+    "worker": Policy(timeout=120, attempts=3, idempotent=False),
+    "analysis": Policy(timeout=60, attempts=3),
+    "images": Policy(timeout=120, attempts=3, idempotent=False),
+    "prediction": Policy(timeout=300, attempts=3, idempotent=False),
+    "poll": Policy(timeout=10, attempts=3, hedge=True),
+    "download": Policy(timeout=60, attempts=3),
+}
+
+# Recent attempt durations per step, the basis of the hedge delay
+_durations = defaultdict(lambda: deque(maxlen=HEDGE_WINDOW))
+_durations_lock = threading.Lock()
+
+
+# Failed Upstream Call, with the HTTP status (if any) read by the retry policies
+class UpstreamError(Exception):
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def status_code(error):
+    # HTTP status of SDK errors (status_code, status) and requests' HTTPError
+    for candidate in (error, getattr(error, "response", None)):
+        for name in ("status_code", "status"):
+            value = getattr(candidate, name, None)
+            if isinstance(value, int):
+                return value
+    return None
+
+
+def transient_errors():
+    # Network Errors of the HTTP libraries loaded so far (all imported lazily)
+    errors = [TimeoutError, ConnectionError]
+    if "requests" in sys.modules:
+        import requests
+
+        errors += [requests.ConnectionError, requests.Timeout]
+    if "httpx" in sys.modules:
+        import httpx
+
+        errors.append(httpx.TransportError)
+    if "openai" in sys.modules:
+        import openai
+
+        errors.append(openai.APIConnectionError)
+    return tuple(errors)
+
+
+def upstream_errors():
+    # Errors of a call that failed for good (retries exhausted, timed out or
+    # rejected): network errors and the API errors of the SDKs loaded so far
+    errors = [UpstreamError, *transient_errors()]
+    if "requests" in sys.modules:
+        import requests
+
+        errors.append(requests.RequestException)
+    if "httpx" in sys.modules:
+        import httpx
+
+        errors.append(httpx.HTTPError)
+    if "openai" in sys.modules:
+        import openai
+
+        errors.append(openai.OpenAIError)
+    if "replicate" in sys.modules:
+        from replicate.exceptions import ReplicateException
+
+        errors.append(ReplicateException)
+    return tuple(errors)
+
+
+def is_retryable(error, idempotent=True):
+    status = status_code(error)
+    if status is not None:
+        return status in (RETRY_STATUSES if idempotent else REJECTED_STATUSES)
+    return idempotent and isinstance(error, transient_errors())
+
+
+def backoff(attempt):
+    # Full jitter keeps retrying sessions from hitting the upstream in step
+    return random.uniform(0, min(MAX_BACKOFF, BACKOFF * 2**attempt))
+
+
+def get_policy_from(step, config):
+    policy = POLICIES.get(step, Policy())
+    prefix = f"RESILIENCE_{step.upper()}_"
+    return Policy(
+        timeout=float(config.get(f"{prefix}TIMEOUT", policy.timeout)),
+        attempts=max(1, int(config.get(f"{prefix}ATTEMPTS", policy.attempts))),
+        idempotent=policy.idempotent,
+        hedge=str(config.get(f"{prefix}HEDGE", policy.hedge)).lower()
+        in ("1", "true", "yes"),
+    )
+
+
+@functools.cache
+def get_policy(step):
+    return get_policy_from(step, load_config())
+
+
+@functools.cache
+def get_hedge_pool():
+    return ThreadPoolExecutor(max_workers=HEDGE_WORKERS, thread_name_prefix="hedge")
+
+
+def hedge_delay(step):
+    with _durations_lock:
+        durations = sorted(_durations[step])
+    if len(durations) < HEDGE_MIN_SAMPLES:
+        return None
+    return durations[math.ceil(HEDGE_QUANTILE * len(durations)) - 1]
+
+
+def timed(step, policy, attempt):
+    started = time.monotonic()
+    result = attempt(policy.timeout)
+    with _durations_lock:
+        _durations[step].append(time.monotonic() - started)
+    return result
+
+
+def hedged(step, backend, policy, attempt):
+    # First successful attempt wins; the slower one finishes in the background
+    delay = hedge_delay(step)
+    if delay is None:
+        return timed(step, policy, attempt)
+
+    pool = get_hedge_pool()
+    first = pool.submit(contextvars.copy_context().run, timed, step, policy, attempt)
+    done, _ = wait([first], timeout=delay)
+    if done:
+        return first.result()
+
+    second = pool.submit(contextvars.copy_context().run, timed, step, policy, attempt)
+    pending = {first, second}
+    error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            try:
+                result = future.result()
+            except Exception as e:
+                error = error or e
+                continue
+            outcome = "won" if future is second else "lost"
+            tracing.record_span("hedge", delay, backend, step, outcome=outcome)
+            return result
+    tracing.record_span("hedge", delay, backend, step, outcome="error")
+    raise error
+
+
+def call(step, backend, attempt):
+    # attempt(timeout) makes one request; transient failures are retried with
+    # backoff, and hedged steps race a second request against a slow first one
+    policy = get_policy(step)
+    for number in range(policy.attempts):
+        try:
+            if policy.hedge:
+                return hedged(step, backend, policy, attempt)
+            return timed(step, policy, attempt)
+        except Exception as e:
+            if number + 1 >= policy.attempts or not is_retryable(e, policy.idempotent):
+                raise
+            delay = backoff(number)
+            tracing.record_span(
+                "retry",
+                delay,
+                backend,
+                step,
+                outcome=str(status_code(e) or type(e).__name__),
+            )
+            time.sleep(delay)
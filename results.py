@@ -0,0 +1,43 @@
+from collections import OrderedDict
+import streamlit as st
+
+
+# Generated Images kept per session, so reruns never fetch them again
+MAX_RESULTS = 8
+MAX_RESULT_BYTES = 64 * 1024 * 1024
+
+
+def result_bytes(results):
+    return sum(len(result["image"]) for result in results.values())
+
+
+def save_results(name, results):
+    store = st.session_state.setdefault("result_store", OrderedDict())
+    store.pop(name, None)
+    store[name] = results
+
+    # Drop the oldest entries beyond the count and size bounds (never the newest)
+    total_bytes = sum(result_bytes(entry) for entry in store.values())
+    while len(store) > 1 and (
+        len(store) > MAX_RESULTS or total_bytes > MAX_RESULT_BYTES
+    ):
+        _, evicted = store.popitem(last=False)
+        total_bytes -= result_bytes(evicted)
+
+
+def load_results(name):
+    return st.session_state.get("result_store", {}).get(name)
+
+
+def drop_results(name):
+    st.session_state.get("result_store", {}).pop(name, None)
+    st.session_state.get("result_errors", {}).pop(name, None)
+
+
+# Styles that failed in the latest Fan-out, shown again after its rerun
+def save_errors(name, errors):
+    st.session_state.setdefault("result_errors", {})[name] = errors
+
+
+def load_errors(name):
+    return st.session_state.get("result_errors", {}).get(name, {})
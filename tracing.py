@@ -0,0 +1,284 @@
+from cache import CACHE_DIR
+from clients import load_config
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logging.handlers import RotatingFileHandler
+import contextvars
+import functools
+import json
+import logging
+import os
+import streamlit as st
+import threading
+import time
+
+
+# Stage Latency Buckets (seconds) of the exported histogram
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+# Rotating Span Log (one JSON object per line, TRACE_FILE="" turns it off)
+TRACE_FILE = os.path.join(CACHE_DIR, "traces.jsonl")
+TRACE_MAX_BYTES = 10 * 1024 * 1024
+TRACE_BACKUPS = 5
+
+logger = logging.getLogger(__name__)
+
+
+# One timed stage of a cartoonization (upload, analysis, inference, download...)
+class Span:
+
+    def __init__(
+        self,
+        stage,
+        backend=None,
+        model=None,
+        bytes_in=0,
+        bytes_out=0,
+        outcome="ok",
+        seconds=0.0,
+    ):
+        self.stage = stage
+        self.backend = backend
+        self.model = model
+        self.bytes_in = bytes_in
+        self.bytes_out = bytes_out
+        self.outcome = outcome
+        self.seconds = seconds
+        self.started = time.time() - seconds
+
+    def to_dict(self):
+        return {
+            "stage": self.stage,
+            "backend": self.backend,
+            "model": self.model,
+            "outcome": self.outcome,
+            "seconds": round(self.seconds, 4),
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "started": round(self.started, 3),
+        }
+
+
+# Spans of one user action, filled from the script run and its worker threads
+class Trace:
+
+    def __init__(self):
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+    @property
+    def seconds(self):
+        with self._lock:
+            if not self.spans:
+                return 0.0
+            return max(span.started + span.seconds for span in self.spans) - min(
+                span.started for span in self.spans
+            )
+
+
+_trace = contextvars.ContextVar("trace", default=None)
+
+# Aggregated Metrics by (stage, backend, model, outcome), shared by the process
+_metrics = {}
+_metrics_lock = threading.Lock()
+
+
+def use_trace(trace):
+    _trace.set(trace)
+    return trace
+
+
+def current_trace():
+    return _trace.get()
+
+
+def session_trace(new=False):
+    # One Trace per session (a fresh one per action), bound to this script run
+    if new or "trace" not in st.session_state:
+        st.session_state.trace = Trace()
+    return use_trace(st.session_state.trace)
+
+
+@functools.cache
+def get_span_log():
+    span_log = logging.getLogger(f"{__name__}.spans")
+    span_log.setLevel(logging.INFO)
+    span_log.propagate = False
+
+    path = load_config().get("TRACE_FILE", TRACE_FILE)
+    if not path:
+        span_log.disabled = True
+        return span_log
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    handler = RotatingFileHandler(
+        path,
+        maxBytes=int(load_config().get("TRACE_MAX_BYTES", TRACE_MAX_BYTES)),
+        backupCount=int(load_config().get("TRACE_BACKUPS", TRACE_BACKUPS)),
+        encoding="utf-8",
+    )
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    span_log.addHandler(handler)
+    return span_log
+
+
+def record(span):
+    labels = (span.stage, span.backend or "", span.model or "", span.outcome)
+    with _metrics_lock:
+        metric = _metrics.setdefault(
+            labels,
+            {
+                "count": 0,
+                "seconds": 0.0,
+                "bytes_in": 0,
+                "bytes_out": 0,
+                "buckets": [0] * len(BUCKETS),
+            },
+        )
+        metric["count"] += 1
+        metric["seconds"] += span.seconds
+        metric["bytes_in"] += span.bytes_in
+        metric["bytes_out"] += span.bytes_out
+        for i, bound in enumerate(BUCKETS):
+            if span.seconds <= bound:
+                metric["buckets"][i] += 1
+
+    trace = _trace.get()
+    if trace is not None:
+        trace.add(span)
+    get_span_log().info(json.dumps(span.to_dict(), ensure_ascii=False))
+
+
+@contextmanager
+def span(stage, backend=None, model=None, bytes_in=0):
+    current = Span(stage, backend, model, bytes_in)
+    started = time.perf_counter()
+    try:
+        yield current
+    except Exception:
+        current.outcome = "error"
+        raise
+    finally:
+        current.seconds = time.perf_counter() - started
+        record(current)
+
+
+def record_span(stage, seconds, backend=None, model=None, outcome="ok", **fields):
+    # Stages timed elsewhere (e.g. a prediction polled across reruns)
+    record(Span(stage, backend, model, outcome=outcome, seconds=seconds, **fields))
+
+
+def format_labels(labels, **extra):
+    names = ("stage", "backend", "model", "outcome")
+    pairs = list(zip(names, labels)) + list(extra.items())
+    return ",".join(
+        '{}="{}"'.format(
+            name,
+            str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"),
+        )
+        for name, value in pairs
+    )
+
+
+def render_metrics():
+    with _metrics_lock:
+        metrics = sorted(
+            (labels, dict(metric, buckets=list(metric["buckets"])))
+            for labels, metric in _metrics.items()
+        )
+
+    # Prometheus Text Exposition Format
+    lines = [
+        "# HELP cartoonize_stage_seconds Duration of cartoonization stages",
+        "# TYPE cartoonize_stage_seconds histogram",
+    ]
+    for labels, metric in metrics:
+        for bound, count in zip(BUCKETS, metric["buckets"]):
+            lines.append(
+                f"cartoonize_stage_seconds_bucket{{{format_labels(labels, le=bound)}}} {count}"
+            )
+        lines.append(
+            f"cartoonize_stage_seconds_bucket{{{format_labels(labels, le='+Inf')}}} {metric['count']}"
+        )
+        lines.append(
+            f"cartoonize_stage_seconds_sum{{{format_labels(labels)}}} {metric['seconds']}"
+        )
+        lines.append(
+            f"cartoonize_stage_seconds_count{{{format_labels(labels)}}} {metric['count']}"
+        )
+
+    for direction in ("in", "out"):
+        lines.append(
+            f"# HELP cartoonize_stage_bytes_{direction}_total Bytes {direction} of cartoonization stages"
+        )
+        lines.append(f"# TYPE cartoonize_stage_bytes_{direction}_total counter")
+        for labels, metric in metrics:
+            lines.append(
+                f"cartoonize_stage_bytes_{direction}_total{{{format_labels(labels)}}} {metric['bytes_' + direction]}"
+            )
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+
+        body = render_metrics().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@functools.cache
+def start_metrics_server():
+    # Serve /metrics once per process, only when METRICS_PORT is configured
+    config = load_config()
+    port = config.get("METRICS_PORT")
+    if not port:
+        return None
+
+    try:
+        server = ThreadingHTTPServer(
+            (config.get("METRICS_HOST", "127.0.0.1"), int(port)), MetricsHandler
+        )
+    except OSError as e:
+        logger.warning("Metrics endpoint not started on port %s: %s", port, e)
+        return None
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def show_trace(trace):
+    if not trace or not trace.spans:
+        return
+
+    with st.expander(f"⏱️ Timings ({trace.seconds:.1f}s)"):
+        st.dataframe(
+            [
+                {
+                    "stage": span.stage,
+                    "backend": span.backend,
+                    "model": span.model,
+                    "outcome": span.outcome,
+                    "seconds": round(span.seconds, 2),
+                    "KB in": round(span.bytes_in / 1024, 1),
+                    "KB out": round(span.bytes_out / 1024, 1),
+                }
+                for span in list(trace.spans)
+            ],
+            hide_index=True,
+            use_container_width=True,
+        )
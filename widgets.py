@@ -0,0 +1,160 @@
+from cache import result_cache
+from clients import load_config
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from results import save_results
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+import admission
+import cartoonize
+import contextvars
+import gallery
+import jobs
+import resilience
+import streamlit as st
+import time
+import tracing
+
+
+# Concurrent Transformations in Multi-Style Mode
+FANOUT_WORKERS = 5
+
+
+def get_image_input(image):
+    # Inline small photos as a data URI, upload the rest to Cloudflare Images
+    config = load_config()
+    try:
+        return cartoonize.get_image_input(
+            image,
+            config.get("CLOUDFLARE_ACCOUNT_ID"),
+            config.get("CLOUDFLARE_API_URL"),
+            config.get("CLOUDFLARE_API_TOKEN_IMAGES"),
+            config.get("REPLICATE_IMAGE_INPUT", cartoonize.REPLICATE_INPUT),
+            int(
+                config.get(
+                    "REPLICATE_INLINE_MAX_BYTES", cartoonize.INLINE_INPUT_MAX_BYTES
+                )
+            ),
+        )
+    except cartoonize.UploadError as e:
+        st.error(f"Failed to upload: {e}")
+        return None
+    except admission.Overloaded as e:
+        st.warning(f"🚦 {e}")
+        return None
+
+
+def run_style_fanout(styles, transform):
+    # Fill a Grid of Placeholders as each Style completes
+    columns = st.columns(2)
+    placeholders = {}
+    for i, style in enumerate(styles):
+        placeholders[style] = columns[i % 2].empty()
+        placeholders[style].info(f"⏳ {style.split(' | ')[1]}...")
+
+    results = {}
+    errors = {}
+    # Workers share the Script Context, so their queue position shows on the page
+    with ThreadPoolExecutor(
+        max_workers=int(load_config().get("FANOUT_WORKERS", FANOUT_WORKERS)),
+        initializer=add_script_run_ctx,
+        initargs=(None, get_script_run_ctx()),
+    ) as executor:
+        futures = {
+            executor.submit(contextvars.copy_context().run, transform, style): style
+            for style in styles
+        }
+        for future in as_completed(futures):
+            style = futures[future]
+            try:
+                results[style] = future.result()
+                placeholders[style].image(
+                    results[style]["image"],
+                    caption=results[style]["caption"],
+                    use_container_width=True,
+                )
+            except admission.Overloaded as e:
+                errors[style] = ("warning", f"🚦 {e}")
+                placeholders[style].warning(errors[style][1])
+            except Exception as e:
+                errors[style] = ("error", f"Failed to transform: {e}")
+                placeholders[style].error(errors[style][1])
+    return results, errors
+
+
+def show_style_errors(errors):
+    # Messages kept per Style (level, message), as the Fan-out showed them
+    for style, (level, message) in errors.items():
+        show = st.warning if level == "warning" else st.error
+        show(f"{style.split(' | ')[1]}: {message}")
+
+
+@st.fragment(run_every=2)
+def watch_replicate_job(client):
+    # The job (st.session_state.replicate_job) holds the prediction id, result
+    # key, model, style, caption, start time and the fields kept in the gallery
+    job = st.session_state.get("replicate_job")
+    if not job:
+        return
+    tracing.session_trace()
+
+    # Poll the Prediction without blocking the rest of the page (a failed poll
+    # is shown, and tried again on the next run)
+    try:
+        prediction = jobs.get_prediction(client, job["id"])
+    except resilience.upstream_errors() as e:
+        st.error(f"Failed to check the transformation: {e}")
+        return
+    if prediction.status in jobs.PENDING_STATUSES:
+        st.info(f"⏳ Transforming... ({prediction.status})")
+        if st.button("Cancel", key="cancel_replicate_job"):
+            try:
+                jobs.cancel_prediction(client, job["id"], job["key"])
+            except resilience.upstream_errors() as e:
+                st.error(f"Failed to cancel: {e}")
+                return
+            del st.session_state.replicate_job
+            tracing.record_span(
+                "inference",
+                time.time() - job["started"],
+                "replicate",
+                job["model"],
+                outcome="canceled",
+            )
+            st.rerun()
+        return
+
+    jobs.finish_prediction(job["key"])
+    del st.session_state.replicate_job
+    tracing.record_span(
+        "inference",
+        time.time() - job["started"],
+        "replicate",
+        job["model"],
+        outcome="ok" if prediction.status == "succeeded" else prediction.status,
+    )
+
+    cartoon_url = jobs.prediction_output_url(prediction)
+    if prediction.status in jobs.FAILED_STATUSES or not cartoon_url:
+        st.session_state.replicate_error = prediction.error or prediction.status
+    else:
+        try:
+            cartoon_image = cartoonize.download_result(cartoon_url)
+        except cartoonize.DownloadError as e:
+            # The prediction is done (and paid): point at its output instead
+            st.session_state.replicate_error = (
+                f"{e} (the result stays there for about an hour)"
+            )
+            st.rerun()
+        result_cache.set(job["key"], cartoon_image)
+        gallery.save(
+            image=cartoon_image,
+            backend="replicate",
+            model=job["model"],
+            caption=job["caption"],
+            seconds=time.time() - job["started"],
+            **job["gallery"],
+        )
+        save_results(
+            "replicate",
+            {job["style"]: {"image": cartoon_image, "caption": job["caption"]}},
+        )
+    st.rerun()